@@ -0,0 +1,200 @@
+import os
+import threading
+
+import numpy as np
+from scipy import sparse
+
+import database
+import similarity_index
+
+# Number of dimensions of the dense embeddings used to route movies to inverted lists.
+DIMENSIONS = 64
+
+# Number of inverted lists scored per query. This is the knob trading recall for speed: probing more lists finds more
+# of the true neighbors, but scores more candidates.
+PROBES = 8
+
+# The list centroids come from a few rounds of k-means over a sample of this many movies per list.
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLE_PER_LIST = 64
+
+# While building a neighbor table, the movies of a list share the lists probed most often by them, up to this many
+# times the number of probes. This bounds the cost of a list even when its movies probe very different lists.
+SHARED_PROBE_FACTOR = 4
+
+# Number of movies embedded or assigned to a list at once while building.
+BUILD_BLOCK_SIZE = 65536
+
+# The index currently loaded in memory, reused until the similarity index it was built from changes.
+_loaded_ann_index = None
+_ann_lock = threading.Lock()
+
+
+# An inverted file index over the similarity index. Every movie is embedded into a few dense dimensions and filed
+# under its closest centroid, so a query only scores the movies filed under the centroids closest to it. Candidates
+# are scored with the exact sparse vectors, so only recall is approximate, never the scores themselves.
+class AnnIndex:
+    def __init__(self, version, projection, centroids, list_offsets, list_positions):
+        self.version = version
+        self.projection = projection
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_positions = list_positions
+
+    def __len__(self):
+        return len(self.centroids)
+
+    # Projects sparse term vectors into the embedding space, normalized so dot products are cosine similarities.
+    def embed(self, rows):
+        embedding = np.asarray(rows @ self.projection, dtype=np.float32)
+        norms = np.linalg.norm(embedding, axis=1, keepdims=True)
+        return embedding / np.where(norms > 0, norms, 1)
+
+    # Returns the lists closest to every embedded row, probes of them per row.
+    def closest_lists(self, embedding, probes=PROBES):
+        probes = min(probes, len(self))
+        centroid_scores = embedding @ self.centroids.T
+        return np.argpartition(-centroid_scores, probes - 1, axis=1)[:, :probes]
+
+    # Returns the positions of every movie filed under the given lists, in ascending order.
+    def list_members(self, lists):
+        return np.sort(np.concatenate([self.list_positions[self.list_offsets[number]:self.list_offsets[number + 1]]
+                                       for number in lists]))
+
+    # Scores a movie against the movies filed under its closest lists. Returns the candidate positions, in ascending
+    # order, and their exact similarity scores.
+    def similarity_scores(self, index, movie_id, probes=PROBES):
+        row = index.matrix[index.position_of(movie_id)]
+        candidates = self.list_members(self.closest_lists(self.embed(row), probes)[0])
+        return candidates, (index.matrix[candidates] @ row.T).toarray().ravel()
+
+    # Builds a neighbor table like similarity_index.build_neighbor_table, one list at a time. The movies of a list
+    # share their candidates, which are the movies of the lists they probe most often, so every block of scores is a
+    # single sparse product.
+    def neighbor_table(self, index, neighbor_count, probes=PROBES,
+                       memory_limit=similarity_index.NEIGHBOR_MEMORY_LIMIT):
+        neighbor_count = min(neighbor_count, max(len(index) - 1, 0))
+        neighbor_ids = np.full((len(index), neighbor_count), -1, dtype=np.int64)
+        neighbor_scores = np.full((len(index), neighbor_count), -np.inf, dtype=similarity_index.SCORE_DTYPE)
+        if neighbor_count == 0:
+            return neighbor_ids, neighbor_scores
+
+        for number in range(len(self)):
+            members = self.list_positions[self.list_offsets[number]:self.list_offsets[number + 1]]
+            if len(members) == 0:
+                continue
+
+            member_vectors = index.matrix[members]
+            lists, counts = np.unique(self.closest_lists(self.embed(member_vectors), probes), return_counts=True)
+            lists = lists[np.argsort(-counts, kind='stable')[:probes * SHARED_PROBE_FACTOR]]
+            candidates = self.list_members(np.union1d(lists, [number]))
+            candidate_vectors = index.matrix[candidates]
+            block_size = similarity_index.neighbor_block_size(len(candidates), memory_limit)
+            for start in range(0, len(members), block_size):
+                block_positions = members[start:start + block_size]
+                block = (candidate_vectors @ member_vectors[start:start + block_size].T).T.toarray()
+
+                # The list itself is always probed, so every movie is among its own candidates.
+                block[np.arange(len(block_positions)), np.searchsorted(candidates, block_positions)] = -np.inf
+
+                # Lists with fewer candidates than the table width are padded like the exact table.
+                candidate_ids = index.movie_ids[candidates]
+                if block.shape[1] < neighbor_count:
+                    padding = neighbor_count - block.shape[1]
+                    block = np.pad(block, ((0, 0), (0, padding)), constant_values=-np.inf)
+                    candidate_ids = np.pad(candidate_ids, (0, padding), constant_values=-1)
+
+                neighbor_ids[block_positions], neighbor_scores[block_positions] = similarity_index.top_neighbors(
+                    block, candidate_ids, neighbor_count)
+        return neighbor_ids, neighbor_scores
+
+
+# Builds an inverted file index over a similarity index. The embedding is either a truncated SVD of the term vectors
+# ("svd") or a random projection ("random"), which is much faster to build but routes queries less accurately.
+# By default there are about as many lists as the square root of the catalog size.
+def build_ann_index(index, dimensions=DIMENSIONS, list_count=None, method="svd", seed=0):
+    rng = np.random.default_rng(seed)
+    movie_count, term_count = index.matrix.shape
+    list_count = max(1, min(list_count or int(np.sqrt(movie_count)), movie_count))
+    dimensions = max(1, min(dimensions, term_count - 1))
+
+    if method == "svd" and movie_count > 1 and term_count > 1:
+        # sklearn is only imported here, when the index is built, since importing it slows down startup.
+        from sklearn.decomposition import TruncatedSVD
+
+        sample = rng.choice(movie_count, min(movie_count, list_count * KMEANS_SAMPLE_PER_LIST * 4), replace=False)
+        dimensions = min(dimensions, len(sample) - 1)
+        svd = TruncatedSVD(dimensions, random_state=seed).fit(index.matrix[np.sort(sample)])
+        projection = svd.components_.T.astype(np.float32)
+    elif method in ("svd", "random"):
+        projection = (rng.standard_normal((term_count, dimensions)) / np.sqrt(dimensions)).astype(np.float32)
+    else:
+        raise ValueError("Unknown embedding method: " + str(method))
+
+    ann = AnnIndex(index.version, projection, np.zeros((list_count, dimensions), dtype=np.float32),
+                   np.zeros(list_count + 1, dtype=np.int64), np.array([], dtype=np.int64))
+    if movie_count == 0:
+        return ann
+
+    # Spherical k-means: centroids start at random movies and move to the normalized mean of the movies closest to
+    # them. A centroid left without movies is moved to another random movie.
+    sample = rng.choice(movie_count, min(movie_count, list_count * KMEANS_SAMPLE_PER_LIST), replace=False)
+    sample_embedding = ann.embed(index.matrix[np.sort(sample)])
+    centroids = sample_embedding[rng.choice(len(sample_embedding), list_count, replace=False)]
+    for _ in range(KMEANS_ITERATIONS):
+        assignments = np.argmax(sample_embedding @ centroids.T, axis=1)
+        membership = sparse.csr_matrix((np.ones(len(assignments), dtype=np.float32),
+                                        (assignments, np.arange(len(assignments)))),
+                                       shape=(list_count, len(assignments)))
+        centroids = np.asarray(membership @ sample_embedding, dtype=np.float32)
+        empty = np.flatnonzero(np.bincount(assignments, minlength=list_count) == 0)
+        centroids[empty] = sample_embedding[rng.choice(len(sample_embedding), len(empty))]
+        norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+        centroids /= np.where(norms > 0, norms, 1)
+    ann.centroids = centroids
+
+    assignments = np.concatenate([np.argmax(ann.embed(index.matrix[start:start + BUILD_BLOCK_SIZE]) @ centroids.T,
+                                            axis=1) for start in range(0, movie_count, BUILD_BLOCK_SIZE)])
+    ann.list_positions = np.argsort(assignments, kind='stable')
+    ann.list_offsets = np.concatenate(([0], np.cumsum(np.bincount(assignments, minlength=list_count))))
+    return ann
+
+
+# The ANN index is stored next to the database file unless another path is given.
+def save_ann_index(ann, path=None):
+    path = path or database.ann_index_path()
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "wb") as file:
+        np.savez(file, version=np.array(ann.version), projection=ann.projection, centroids=ann.centroids,
+                 list_offsets=ann.list_offsets, list_positions=ann.list_positions)
+    os.replace(temporary_path, path)
+
+
+# Returns the ANN index stored on disk, or None if there is no usable index file.
+def load_ann_index(path=None):
+    path = path or database.ann_index_path()
+    if not os.path.exists(path):
+        return None
+
+    with np.load(path) as arrays:
+        return AnnIndex(arrays["version"].item(), arrays["projection"], arrays["centroids"], arrays["list_offsets"],
+                        arrays["list_positions"])
+
+
+# Returns an ANN index matching the given similarity index, reusing the one in memory, then the one on disk, and
+# only building a new one if both are out of date.
+def get_ann_index(index, path=None):
+    global _loaded_ann_index
+    path = path or database.ann_index_path()
+
+    with _ann_lock:
+        if _loaded_ann_index is not None and _loaded_ann_index.version == index.version:
+            return _loaded_ann_index
+
+        ann = load_ann_index(path)
+        if ann is None or ann.version != index.version:
+            ann = build_ann_index(index)
+            save_ann_index(ann, path)
+
+        _loaded_ann_index = ann
+        return ann
@@ -0,0 +1,103 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+
+import ann_index
+import database
+import similarity_index
+import sqlite_functions
+import synthetic_data
+
+
+# Measures the recall@k of ANN queries against exact scoring for a sample of movies, for each number of probes.
+# With neighbor_table, the recall of an approximate neighbor table is measured against exact neighbors as well.
+def recall_report(index, ann, probe_counts, k=10, query_count=200, neighbor_table=False, seed=0):
+    rng = np.random.default_rng(seed)
+    queries = rng.choice(len(index), min(query_count, len(index)), replace=False)
+
+    exact = []
+    start = time.perf_counter()
+    for position in queries:
+        scores = index.similarity_scores(index.movie_ids[position])
+        scores[position] = -np.inf
+        exact.append(set(similarity_index.top_k_positions(scores, k).tolist()))
+    exact_ms = (time.perf_counter() - start) * 1000 / len(queries)
+    exact_neighbors = similarity_index.neighbors_for_positions(index, queries, k)[0] if neighbor_table else None
+
+    report = []
+    for probes in probe_counts:
+        found, candidate_count = 0, 0
+        start = time.perf_counter()
+        for position, true_positions in zip(queries, exact):
+            candidates, scores = ann.similarity_scores(index, index.movie_ids[position], probes)
+            scores[candidates == position] = -np.inf
+            found += len(true_positions & set(candidates[similarity_index.top_k_positions(scores, k)].tolist()))
+            candidate_count += len(candidates)
+        result = {
+            "probes": probes,
+            "recall": round(found / max(sum(len(true_positions) for true_positions in exact), 1), 4),
+            "query_ms": round((time.perf_counter() - start) * 1000 / len(queries), 3),
+            "exact_query_ms": round(exact_ms, 3),
+            "mean_candidates": round(candidate_count / len(queries), 1),
+        }
+
+        if neighbor_table:
+            start = time.perf_counter()
+            approximate_neighbors = ann.neighbor_table(index, k, probes)[0][queries]
+            result["neighbor_table_seconds"] = round(time.perf_counter() - start, 3)
+            result["neighbor_table_recall"] = round(np.mean([
+                len(np.intersect1d(row[row >= 0], true_row[true_row >= 0])) / max(np.count_nonzero(true_row >= 0), 1)
+                for row, true_row in zip(approximate_neighbors, exact_neighbors)]), 4)
+        report.append(result)
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Reports the recall@k of the ANN index against exact scoring.")
+    parser.add_argument("--movies", type=int, default=20000, help="size of the synthetic catalog")
+    parser.add_argument("--database", help="measure an existing database instead of a synthetic catalog")
+    parser.add_argument("--probes", type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--dimensions", type=int, default=ann_index.DIMENSIONS)
+    parser.add_argument("--lists", type=int, help="number of inverted lists, by default the square root of the "
+                                                  "catalog size")
+    parser.add_argument("--method", choices=["svd", "random"], default="svd")
+    parser.add_argument("--neighbor-table", action="store_true", help="also measure approximate neighbor tables")
+    parser.add_argument("--output", help="JSON file the report is written to")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        if args.database:
+            database.configure(args.database)
+        else:
+            database.configure(os.path.join(directory, "ann.db"))
+            sqlite_functions.generate_tables()
+            with database.connection() as conn:
+                synthetic_data.populate_database(conn, args.movies, 0, 0)
+
+        with database.connection() as conn:
+            # The exact neighbor table is not needed here, and would take far longer to build than the ANN index.
+            similarity = similarity_index.build_similarity_index(conn, neighbor_count=0)
+        database.configure()
+
+    start = time.perf_counter()
+    ann = ann_index.build_ann_index(similarity, args.dimensions, args.lists, args.method)
+    print(str(len(similarity)) + " movies, " + str(len(ann)) + " lists, " + args.method + " embedding built in "
+          + str(round(time.perf_counter() - start, 2)) + " s")
+
+    recall = recall_report(similarity, ann, args.probes, args.k, args.queries, args.neighbor_table)
+    for result in recall:
+        print("probes {probes:>4}: recall@{k} {recall:.3f}, {query_ms:.3f} ms per query "
+              "(exact {exact_query_ms:.3f} ms), {mean_candidates:.0f} candidates".format(k=args.k, **result) +
+              ("" if "neighbor_table_recall" not in result else
+               ", neighbor table recall {neighbor_table_recall:.3f} in {neighbor_table_seconds:.1f} s".format(**result)))
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({"movies": len(similarity), "lists": len(ann), "method": args.method, "k": args.k,
+                       "results": recall}, file, indent=2)
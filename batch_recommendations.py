@@ -0,0 +1,209 @@
+import argparse
+import os
+import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import datetime, timezone
+
+import numpy as np
+from scipy import sparse
+
+import database
+import movie_recommender_functions
+import similarity_index
+import sqlite_functions
+import synthetic_data
+
+# Number of recommendations stored per user.
+QUANTITY = 10
+
+# Upper bound, in bytes, on the scores of one chunk of users against the catalog. The number of users per chunk
+# follows from it, up to MAX_CHUNK_USERS.
+CHUNK_MEMORY_LIMIT = 256 * 1024 * 1024
+MAX_CHUNK_USERS = 1000
+
+# Users without enough scored movies are filled up from the first movies by ID they have not watched or ignored,
+# like the top ten movies of recommend_based_on_watch_history.
+FILLER_POOL = 10
+
+# The similarity index of a worker process, loaded once when the process starts.
+_worker_index = None
+
+
+def _load_worker_index(path, version):
+    global _worker_index
+    _worker_index = similarity_index.load_similarity_index(path)
+    if _worker_index is None or _worker_index.version != version:
+        raise RuntimeError("The similarity index on disk does not match the catalog.")
+
+
+# Reads the watch history of a chunk of users, given their IDs in ascending order, with a primary key range query.
+# Returns the liked movies as (row, position, recency weight) arrays and the watched or ignored movies as
+# (row, position) arrays, where rows index user_ids.
+def read_chunk_history(conn, index, user_ids):
+    rows = conn.execute("SELECT user_id, movie_id, watched, liked, ignored, "
+                        "julianday('now') - julianday(COALESCE(last_edited, creation_date)) "
+                        "FROM watch_history "
+                        "WHERE user_id BETWEEN ? AND ?", (int(user_ids[0]), int(user_ids[-1]))).fetchall()
+    if not rows:
+        empty = np.array([], dtype=np.int64)
+        return (empty, empty, np.array([], dtype=np.float32)), (empty, empty)
+
+    history = np.array([row[:5] for row in rows], dtype=np.int64)
+    ages = np.array([row[5] or 0.0 for row in rows], dtype=np.float64)
+
+    # Rows for movies missing from the index are dropped, like in the online recommendations.
+    in_index = np.isin(history[:, 1], index.movie_ids)
+    history, ages = history[in_index], ages[in_index]
+    user_rows = np.searchsorted(user_ids, history[:, 0])
+    positions = np.searchsorted(index.movie_ids, history[:, 1])
+
+    liked = (history[:, 3] == 1) & (history[:, 4] == 0)
+    weights = 0.5 ** (np.maximum(ages[liked], 0.0) / movie_recommender_functions.RECENCY_HALF_LIFE_DAYS)
+    excluded = (history[:, 2] == 1) | (history[:, 4] == 1) | liked
+    return ((user_rows[liked], positions[liked], weights.astype(np.float32)),
+            (user_rows[excluded], positions[excluded]))
+
+
+# Scores a chunk of users against the catalog with two sparse products: the weighted like-matrix times the feature
+# matrix gives every user's taste profile, and the feature matrix times the profiles scores every movie for every user.
+# Returns (user ID, rank, movie ID, score, reason movie ID) rows.
+def recommend_chunk(user_ids, liked, excluded, quantity, index=None):
+    index = index if index is not None else _worker_index
+    liked_rows, liked_positions, liked_weights = liked
+    excluded_rows, excluded_positions = excluded
+
+    likes = sparse.csr_matrix((liked_weights, (liked_rows, liked_positions)), shape=(len(user_ids), len(index)),
+                              dtype=similarity_index.SCORE_DTYPE)
+    profiles = likes @ index.matrix
+    scores = (index.matrix @ profiles.T).T.toarray()
+
+    # Movies sharing no feature with any liked movie are not recommended for their score, nor are excluded movies.
+    scores[scores <= 0] = -np.inf
+    scores[excluded_rows, excluded_positions] = -np.inf
+    top_ids, top_scores = similarity_index.top_neighbors(scores, index.movie_ids, min(quantity, len(index)))
+
+    # The reason for each recommendation is the liked movie with the best weighted similarity to it. Every (liked
+    # movie, recommendation) pair of a user is scored at once, as the row-wise dot products of two sparse matrices.
+    found = top_ids >= 0
+    recommended_rows, recommended_ranks = np.nonzero(found)
+    recommended_positions = np.searchsorted(index.movie_ids, top_ids[found])
+    liked_order = np.argsort(liked_rows, kind='stable')
+    liked_counts = np.bincount(liked_rows, minlength=len(user_ids))
+    liked_starts = np.concatenate(([0], np.cumsum(liked_counts)))
+
+    pair_recommendations = np.repeat(np.arange(len(recommended_rows)), liked_counts[recommended_rows])
+    pair_offsets = np.arange(len(pair_recommendations)) - np.repeat(
+        np.cumsum(liked_counts[recommended_rows]) - liked_counts[recommended_rows], liked_counts[recommended_rows])
+    pair_liked = liked_order[liked_starts[recommended_rows[pair_recommendations]] + pair_offsets]
+    pair_scores = np.asarray(index.matrix[liked_positions[pair_liked]].multiply(
+        index.matrix[recommended_positions[pair_recommendations]]).sum(axis=1)).ravel() * liked_weights[pair_liked]
+
+    # The best pair of every recommendation, ties going to the first liked movie like argmax.
+    best = np.lexsort((np.arange(len(pair_scores)), -pair_scores, pair_recommendations))
+    first = np.ones(len(best), dtype=bool)
+    first[1:] = pair_recommendations[best][1:] != pair_recommendations[best][:-1]
+    reasons = np.full(found.shape, -1, dtype=np.int64)
+    reasons[recommended_rows[pair_recommendations[best[first]]], recommended_ranks[pair_recommendations[best[first]]]] = \
+        index.movie_ids[liked_positions[pair_liked[best[first]]]]
+
+    results = []
+    excluded_order = np.argsort(excluded_rows, kind='stable')
+    excluded_starts = np.searchsorted(excluded_rows[excluded_order], np.arange(len(user_ids) + 1))
+
+    for row, user_id in enumerate(user_ids):
+        movie_ids, movie_scores = top_ids[row][found[row]], top_scores[row][found[row]]
+        reasons_of_user = [reason if reason >= 0 else None for reason in reasons[row][found[row]].tolist()]
+
+        user_results = [(int(user_id), rank, movie_id, float(score), reason)
+                        for rank, (movie_id, score, reason) in enumerate(zip(movie_ids.tolist(), movie_scores,
+                                                                              reasons_of_user), start=1)]
+
+        if len(user_results) < quantity:
+            unavailable = np.zeros(len(index), dtype=bool)
+            unavailable[excluded_positions[excluded_order[excluded_starts[row]:excluded_starts[row + 1]]]] = True
+            unavailable[np.searchsorted(index.movie_ids, movie_ids)] = True
+            fillers = np.flatnonzero(~unavailable)[:FILLER_POOL][:quantity - len(user_results)]
+            user_results += [(int(user_id), len(user_results) + rank, int(index.movie_ids[position]), None, None)
+                             for rank, position in enumerate(fillers, start=1)]
+        results += user_results
+    return results
+
+
+# Writes the recommendations of a chunk of users, replacing the ones they had.
+def write_chunk(user_ids, results, created_at):
+    with database.transaction() as conn:
+        conn.execute("DELETE FROM user_recommendations WHERE user_id BETWEEN ? AND ?",
+                     (int(user_ids[0]), int(user_ids[-1])))
+        conn.executemany("INSERT INTO user_recommendations(user_id, rank, movie_id, score, reason_movie_id, "
+                         "created_at) VALUES(?, ?, ?, ?, ?, ?)",
+                         [result + (created_at,) for result in results])
+
+
+# Precomputes the recommendations of every user and stores them in user_recommendations. Users are read and scored a
+# chunk at a time, and with more than one process the chunks are scored by a pool of worker processes, each of which
+# loads the similarity index from disk once. Returns the number of users and the seconds it took.
+def recommend_all_users(quantity=QUANTITY, processes=None, memory_limit=CHUNK_MEMORY_LIMIT):
+    start = time.perf_counter()
+    created_at = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+    with database.connection() as conn:
+        index = similarity_index.get_similarity_index(conn)
+        user_ids = np.array([row[0] for row in conn.execute("SELECT id FROM users ORDER BY id")], dtype=np.int64)
+
+    if len(index) == 0:
+        return len(user_ids), time.perf_counter() - start
+
+    chunk_size = min(MAX_CHUNK_USERS, similarity_index.neighbor_block_size(len(index), memory_limit))
+    chunks = [user_ids[start_row:start_row + chunk_size] for start_row in range(0, len(user_ids), chunk_size)]
+
+    if processes is None or processes <= 1:
+        for chunk in chunks:
+            with database.connection() as conn:
+                liked, excluded = read_chunk_history(conn, index, chunk)
+            write_chunk(chunk, recommend_chunk(chunk, liked, excluded, quantity, index), created_at)
+        return len(user_ids), time.perf_counter() - start
+
+    # At most two chunks per process wait in the pool, so memory stays bounded however many users there are.
+    with ProcessPoolExecutor(processes, initializer=_load_worker_index,
+                             initargs=(database.index_path(), index.version)) as pool:
+        running = {}
+        for chunk in chunks + [None]:
+            if chunk is not None:
+                with database.connection() as conn:
+                    liked, excluded = read_chunk_history(conn, index, chunk)
+                running[pool.submit(recommend_chunk, chunk, liked, excluded, quantity)] = chunk
+
+            while running and (chunk is None or len(running) >= processes * 2):
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    write_chunk(running.pop(future), future.result(), created_at)
+    return len(user_ids), time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Precomputes recommendations for every user.")
+    parser.add_argument("--quantity", type=int, default=QUANTITY, help="recommendations stored per user")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), help="worker processes scoring users")
+    parser.add_argument("--synthetic", action="store_true",
+                        help="run on a temporary synthetic database instead, to measure throughput")
+    parser.add_argument("--movies", type=int, default=10000, help="synthetic catalog size")
+    parser.add_argument("--users", type=int, default=10000, help="synthetic user count")
+    parser.add_argument("--history", type=int, default=50, help="synthetic watch history rows per user")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        if args.synthetic:
+            database.configure(os.path.join(directory, "batch.db"))
+            sqlite_functions.generate_tables()
+            with database.connection() as conn:
+                synthetic_data.populate_database(conn, args.movies, args.users, args.history)
+            movie_recommender_functions.load_similarity_index()
+        else:
+            sqlite_functions.generate_tables()
+
+        user_count, seconds = recommend_all_users(args.quantity, args.processes)
+        print("Recommended movies for " + str(user_count) + " users in " + format(seconds, ".2f") + " s (" +
+              format(user_count / seconds if seconds else 0, ".1f") + " users/s with " + str(args.processes) +
+              " processes).")
+        database.configure()
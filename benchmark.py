@@ -0,0 +1,217 @@
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import numpy as np
+
+import database
+import movie_recommender_functions
+import result_cache
+import similarity_index
+import sqlite_functions
+import synthetic_data
+
+PERCENTILES = [50, 95, 99]
+
+# An entry point counts as a regression when its p95 latency grew by more than this fraction over the baseline.
+REGRESSION_TOLERANCE = 0.2
+
+
+# Calls a function once per argument tuple and returns its latency percentiles, throughput and peak memory.
+# Latencies are measured without tracemalloc, which slows Python down, and the peak memory comes from one extra call
+# traced on its own. A setup function, if given, runs untimed before every call.
+def measure(function, calls, setup=None):
+    latencies = []
+    for arguments in calls:
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function(*arguments)
+        latencies.append(time.perf_counter() - start)
+
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    try:
+        function(*calls[0])
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    latencies = np.array(latencies) * 1000
+    result = {"calls": len(calls)}
+    for percentile in PERCENTILES:
+        result["p" + str(percentile) + "_ms"] = round(float(np.percentile(latencies, percentile)), 3)
+    result["mean_ms"] = round(float(latencies.mean()), 3)
+    result["throughput_per_second"] = round(len(calls) / (latencies.sum() / 1000), 2)
+    result["peak_memory_bytes"] = peak_memory
+    return result
+
+
+# Returns the search terms used for select_movie: whole titles, title prefixes and titles with two letters swapped.
+def search_terms(rng, titles, count):
+    terms = []
+    for title in rng.sample(titles, min(count, len(titles))):
+        kind = len(terms) % 3
+        if kind == 0:
+            terms.append(title)
+        elif kind == 1:
+            terms.append(title.split()[0][:4])
+        else:
+            position = rng.randrange(max(len(title) - 1, 1))
+            terms.append(title[:position] + title[position + 1:position + 2] + title[position:position + 1]
+                         + title[position + 2:])
+    return terms
+
+
+# Times load_movie_data on a synthetic CSV, loading it into a fresh database file on every call.
+def benchmark_load_movie_data(directory, movie_count, repeats, seed):
+    csv_path = os.path.join(directory, "movies.csv")
+    synthetic_data.write_movies_csv(csv_path, movie_count, seed)
+    run = [0]
+
+    def fresh_database():
+        run[0] += 1
+        database.configure(os.path.join(directory, "load-" + str(run[0]) + ".db"))
+        sqlite_functions.generate_tables()
+
+    try:
+        return measure(lambda: sqlite_functions.load_movie_data(movies_data_csv=csv_path),
+                       [()] * repeats, setup=fresh_database)
+    except LookupError as error:
+        # Tags cannot be cleaned without the NLTK corpora, which are never downloaded by the benchmark.
+        return {"skipped": str(error)}
+
+
+# Builds a synthetic database of the given size and times every entry point against it.
+def benchmark_catalog(movie_count, user_count, history_size, query_count, load_repeats, seed):
+    rng = random.Random(seed)
+    result = {"movies": movie_count, "users": user_count, "history_size": history_size}
+    entry_points = {}
+
+    with tempfile.TemporaryDirectory() as directory:
+        database.configure(os.path.join(directory, "benchmark.db"))
+        sqlite_functions.generate_tables()
+
+        start = time.perf_counter()
+        with database.connection() as conn:
+            user_ids = synthetic_data.populate_database(conn, movie_count, user_count, history_size, seed)
+            movies = conn.execute("SELECT id, title FROM movies").fetchall()
+        result["populate_seconds"] = round(time.perf_counter() - start, 3)
+
+        # Building the similarity index and its neighbor table is timed apart from loading the saved index from disk.
+        def remove_index():
+            similarity_index.unload_similarity_index()
+            if os.path.exists(database.index_path()):
+                os.remove(database.index_path())
+            shutil.rmtree(similarity_index.catalog_path(), ignore_errors=True)
+
+        entry_points["build_similarity_index"] = measure(movie_recommender_functions.load_similarity_index, [()],
+                                                         setup=remove_index)
+        entry_points["load_similarity_index"] = measure(movie_recommender_functions.load_similarity_index,
+                                                        [()] * 3, setup=similarity_index.unload_similarity_index)
+
+        # Recommendations are timed with empty result caches, then once more answering the same calls from them.
+        users = [rng.choice(user_ids) for _ in range(query_count)]
+        similar_calls = [(rng.choice(movies)[0], user_id, 6) for user_id in users]
+        entry_points["get_recommended_movies"] = measure(movie_recommender_functions.get_recommended_movies,
+                                                         similar_calls, setup=result_cache.clear)
+        entry_points["recommend_based_on_watch_history"] = measure(
+            movie_recommender_functions.recommend_based_on_watch_history, [(user_id,) for user_id in users],
+            setup=result_cache.clear)
+        for name, function, calls in (("get_recommended_movies", movie_recommender_functions.get_recommended_movies,
+                                       similar_calls),
+                                      ("recommend_based_on_watch_history",
+                                       movie_recommender_functions.recommend_based_on_watch_history,
+                                       [(user_id,) for user_id in users])):
+            for arguments in calls:
+                function(*arguments)
+            entry_points[name + " (cached)"] = measure(function, calls)
+        entry_points["select_movie"] = measure(
+            sqlite_functions.select_movie,
+            [(term, user_id) for term, user_id in zip(search_terms(rng, [movie[1] for movie in movies], query_count),
+                                                      users)])
+
+        if load_repeats:
+            entry_points["load_movie_data"] = benchmark_load_movie_data(directory, movie_count, load_repeats, seed)
+
+        database.configure()
+        similarity_index.unload_similarity_index()
+
+    result["entry_points"] = entry_points
+    return result
+
+
+# Compares a run with a previous one, returning a line for every entry point whose p95 latency regressed.
+def find_regressions(results, baseline, tolerance=REGRESSION_TOLERANCE):
+    previous = {catalog["movies"]: catalog["entry_points"] for catalog in baseline["catalogs"]}
+    regressions = []
+    for catalog in results["catalogs"]:
+        for name, current in catalog["entry_points"].items():
+            before = previous.get(catalog["movies"], {}).get(name)
+            if not before or "p95_ms" not in before or "p95_ms" not in current:
+                continue
+            if current["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+                regressions.append(name + " with " + str(catalog["movies"]) + " movies: p95 " +
+                                   str(before["p95_ms"]) + " ms -> " + str(current["p95_ms"]) + " ms")
+    return regressions
+
+
+def print_catalog(catalog):
+    print(str(catalog["movies"]) + " movies, " + str(catalog["users"]) + " users with " +
+          str(catalog["history_size"]) + " history rows each (populated in " + str(catalog["populate_seconds"]) + " s)")
+    print("    {:<44}{:>8}{:>11}{:>11}{:>11}{:>12}{:>12}".format("Entry point", "Calls", "p50 ms", "p95 ms", "p99 ms",
+                                                            "Calls/s", "Peak MB"))
+    for name, result in catalog["entry_points"].items():
+        if "skipped" in result:
+            print("    {:<44}skipped: {}".format(name, result["skipped"]))
+            continue
+        print("    {:<44}{:>8}{:>11.3f}{:>11.3f}{:>11.3f}{:>12.2f}{:>12.1f}".format(
+            name, result["calls"], result["p50_ms"], result["p95_ms"], result["p99_ms"],
+            result["throughput_per_second"], result["peak_memory_bytes"] / 1e6))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Times the main entry points against synthetic catalogs.")
+    parser.add_argument("--movies", type=int, nargs='+', default=[10000], help="catalog sizes to benchmark")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--history", type=int, default=100, help="watch history rows per user")
+    parser.add_argument("--queries", type=int, default=200, help="calls per entry point")
+    parser.add_argument("--load-repeats", type=int, default=3, help="times load_movie_data runs, 0 to skip it")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="JSON file the results are written to")
+    parser.add_argument("--baseline", help="JSON file of a previous run; exits with an error on p95 regressions")
+    args = parser.parse_args()
+
+    results = {
+        "created": datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {"users": args.users, "history_size": args.history, "queries": args.queries,
+                     "load_repeats": args.load_repeats, "seed": args.seed},
+        "catalogs": [],
+    }
+    for movie_count in args.movies:
+        catalog = benchmark_catalog(movie_count, args.users, args.history, args.queries, args.load_repeats, args.seed)
+        results["catalogs"].append(catalog)
+        print_catalog(catalog)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+        print("Results written to " + args.output)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = find_regressions(results, json.load(file))
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        sys.exit(1 if regressions else 0)
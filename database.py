@@ -0,0 +1,261 @@
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import instrumentation
+
+# The database file can be moved with the MOVIE_RECOMMENDER_DB environment variable, or with configure().
+DATABASE_PATH = os.environ.get("MOVIE_RECOMMENDER_DB", "movie-records.db")
+
+# Maximum number of connections open at once. Threads asking for a connection beyond this wait for a free one.
+POOL_SIZE = 8
+
+# Number of compiled statements each connection keeps, so repeated queries skip parsing and planning.
+STATEMENT_CACHE_SIZE = 256
+
+# Pragmas applied to every new connection. WAL lets readers run while another connection writes, and NORMAL
+# synchronous is safe in WAL mode while syncing far less often. A negative cache_size is in KiB.
+PRAGMAS = [
+    ("journal_mode", "WAL"),
+    ("synchronous", "NORMAL"),
+    ("cache_size", -65536),
+    ("mmap_size", 268435456),
+    ("busy_timeout", 5000),
+    ("foreign_keys", 1),  # Necessary for the cascading delete of users and watch history.
+]
+
+# Pragmas applied for the length of a bulk_load() block. Without synchronous writes, a power loss during the load can
+# leave the database file damaged, so they are only meant for loads that can be run again from scratch.
+BULK_LOAD_PRAGMAS = [
+    ("synchronous", "OFF"),
+    ("cache_size", -262144),
+    ("temp_store", "MEMORY"),
+]
+
+# The pool used by connection() and transaction(), created on first use.
+_pool = None
+_pool_lock = threading.Lock()
+
+
+# A connection timing every statement it runs and counting the rows they return, opened while instrumentation is on.
+class TimedConnection(sqlite3.Connection):
+    def cursor(self, factory=None):
+        return super().cursor(factory or TimedCursor)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, parameters):
+        return self.cursor().executemany(sql, parameters)
+
+
+class TimedCursor(sqlite3.Cursor):
+    statement = None
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        super().execute(sql, parameters)
+        self.statement = sql
+        # Changed rows are known once the statement ran, while selected rows are counted as they are fetched.
+        instrumentation.record_sql(sql, time.perf_counter() - start, max(self.rowcount, 0))
+        return self
+
+    def executemany(self, sql, parameters):
+        start = time.perf_counter()
+        super().executemany(sql, parameters)
+        self.statement = None
+        instrumentation.record_sql(sql, time.perf_counter() - start, max(self.rowcount, 0))
+        return self
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        instrumentation.record_sql_fetch(self.statement, time.perf_counter() - start, int(row is not None))
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        instrumentation.record_sql_fetch(self.statement, time.perf_counter() - start, len(rows))
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        instrumentation.record_sql_fetch(self.statement, time.perf_counter() - start, len(rows))
+        return rows
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            instrumentation.record_sql_fetch(self.statement, time.perf_counter() - start, 0)
+            raise
+        instrumentation.record_sql_fetch(self.statement, time.perf_counter() - start, 1)
+        return row
+
+
+# A small pool of SQLite connections. A thread checks a connection out for the length of a connection() block, and
+# nested blocks on the same thread reuse it, so one request never opens more than one connection.
+class ConnectionPool:
+    def __init__(self, path=DATABASE_PATH, size=POOL_SIZE):
+        self.path = path
+        self.size = size
+        self._idle = []
+        self._open_count = 0
+        self._available = threading.Condition()
+        self._local = threading.local()
+
+    def _open(self):
+        # Connections move between threads as they are checked in and out, but only one thread uses one at a time.
+        # Statements are only timed while instrumentation is on or the thread is in instrumentation.capture(), so plain
+        # connections pay nothing for it.
+        factory = TimedConnection if _timed() else sqlite3.Connection
+        conn = sqlite3.connect(self.path, cached_statements=STATEMENT_CACHE_SIZE, check_same_thread=False,
+                               factory=factory)
+        for name, value in PRAGMAS:
+            conn.execute("PRAGMA " + name + " = " + str(value))
+        return conn
+
+    def _check_out(self):
+        with self._available:
+            while not self._idle and self._open_count >= self.size:
+                self._available.wait()
+            conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                self._open_count += 1
+
+        # An idle connection of the wrong kind, opened before instrumentation was switched on or off or for a captured
+        # request, is replaced by one of the other kind.
+        if conn is not None:
+            if isinstance(conn, TimedConnection) == _timed():
+                return conn
+            conn.close()
+
+        try:
+            return self._open()
+        except Exception:
+            with self._available:
+                self._open_count -= 1
+                self._available.notify()
+            raise
+
+    def _check_in(self, conn):
+        with self._available:
+            if self._open_count > self.size:
+                # The pool was shrunk or closed while this connection was in use.
+                self._open_count -= 1
+                conn.close()
+            else:
+                self._idle.append(conn)
+            self._available.notify()
+
+    @contextmanager
+    def connection(self):
+        held = getattr(self._local, "conn", None)
+        if held is not None:
+            yield held
+            return
+
+        conn = self._check_out()
+        self._local.conn = conn
+        try:
+            yield conn
+        finally:
+            self._local.conn = None
+            if conn.in_transaction:
+                conn.rollback()
+            self._check_in(conn)
+
+    # Runs the block in a transaction that is committed when the block ends and rolled back if it raises.
+    # Nested transaction() blocks on the same thread join the outer transaction.
+    @contextmanager
+    def transaction(self):
+        with self.connection() as conn:
+            depth = getattr(self._local, "transaction_depth", 0)
+            self._local.transaction_depth = depth + 1
+            try:
+                yield conn
+                if depth == 0:
+                    conn.commit()
+            except BaseException:
+                if depth == 0:
+                    conn.rollback()
+                raise
+            finally:
+                self._local.transaction_depth = depth
+
+    # Closes every idle connection. Connections still checked out are closed when they are returned.
+    def close(self):
+        with self._available:
+            for conn in self._idle:
+                conn.close()
+            self._open_count -= len(self._idle)
+            self._idle = []
+            self.size = 0
+
+
+# Tells whether connections checked out by this thread should time their statements.
+def _timed():
+    return instrumentation.ENABLED or instrumentation.capturing()
+
+
+# Points the module at another database file and/or pool size, closing the connections of the previous pool.
+def configure(path=None, pool_size=None):
+    global _pool, DATABASE_PATH, POOL_SIZE
+    with _pool_lock:
+        if path is not None:
+            DATABASE_PATH = path
+        if pool_size is not None:
+            POOL_SIZE = pool_size
+        if _pool is not None:
+            _pool.close()
+        _pool = None
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(DATABASE_PATH, POOL_SIZE)
+        return _pool
+
+
+# Returns the path of the similarity index stored next to the database file.
+def index_path():
+    return os.path.splitext(DATABASE_PATH)[0] + "-index.npz"
+
+
+# Returns the path of the approximate nearest-neighbor index stored next to the database file.
+def ann_index_path():
+    return os.path.splitext(DATABASE_PATH)[0] + "-ann.npz"
+
+
+def connection():
+    return get_pool().connection()
+
+
+def transaction():
+    return get_pool().transaction()
+
+
+# Runs the block in a single transaction with BULK_LOAD_PRAGMAS applied, restoring the connection's previous settings
+# once it ends. The transaction starts right away and takes the write lock, so statements that do not start one
+# implicitly, such as dropping a trigger, are rolled back too if the block raises.
+@contextmanager
+def bulk_load():
+    with connection() as conn:
+        previous = [(name, conn.execute("PRAGMA " + name).fetchone()[0]) for name, _ in BULK_LOAD_PRAGMAS]
+        for name, value in BULK_LOAD_PRAGMAS:
+            conn.execute("PRAGMA " + name + " = " + str(value))
+        try:
+            with transaction():
+                if not conn.in_transaction:
+                    conn.execute("BEGIN IMMEDIATE")
+                yield conn
+        finally:
+            for name, value in previous:
+                conn.execute("PRAGMA " + name + " = " + str(value))
@@ -0,0 +1,151 @@
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+import instrumentation
+
+# Maximum number of users whose exclusions are kept in memory. The least recently used user is evicted first.
+CACHE_SIZE = 1024
+
+# Entries are reloaded from the database after this many seconds, in case another process changed the watch history.
+CACHE_TTL_SECONDS = 600
+
+# Number of users whose last change is remembered, so bitmaps read while their watch history changed are not cached.
+REMEMBERED_CHANGES = 4096
+
+
+# The watched and ignored movies of one user, stored as bitmaps over the row positions of a similarity index.
+# A bitmap takes one bit per movie, so a user costs about 25 KB for a catalog of 100,000 movies.
+class UserExclusions:
+    def __init__(self, index, watched, ignored):
+        self.index = index
+        self.watched = watched
+        self.ignored = ignored
+        self.loaded_at = time.monotonic()
+
+    # Returns a boolean mask over the index positions of movies the user has ignored.
+    def ignored_mask(self):
+        return np.unpackbits(self.ignored, count=len(self.index)).view(bool)
+
+    # Returns a boolean mask over the index positions of movies that are never recommended to the user, meaning the
+    # ones they have watched or ignored.
+    def excluded_mask(self):
+        return np.unpackbits(self.watched | self.ignored, count=len(self.index)).view(bool)
+
+    def ignored_count(self):
+        return int(np.unpackbits(self.ignored).sum())
+
+    def set_flags(self, position, watched, ignored):
+        byte, bit = divmod(int(position), 8)
+        mask = np.uint8(0x80 >> bit)
+        for bitmap, flag in ((self.watched, watched), (self.ignored, ignored)):
+            if flag:
+                bitmap[byte] |= mask
+            else:
+                bitmap[byte] &= ~mask
+
+
+# Keeps the exclusions of recently active users, so recommendations and searches can apply them as a vectorized mask
+# instead of asking the database again on every call.
+class ExclusionCache:
+    def __init__(self, max_users=CACHE_SIZE, ttl_seconds=CACHE_TTL_SECONDS):
+        self.max_users = max_users
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Every change to a user's watch history bumps the generation and is remembered per user, up to
+        # REMEMBERED_CHANGES users; bitmaps read before a change to their user are returned but not cached.
+        self.generation = 0
+        self._changed = OrderedDict()
+        self._forgotten_generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    # Returns the exclusions of a user for the given index, loading them on first use or when they are out of date.
+    def get(self, conn, user_id, index):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if (entry is not None and entry.index is index
+                    and time.monotonic() - entry.loaded_at < self.ttl_seconds):
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry
+            self.misses += 1
+            generation = self.generation
+
+        entry = load_user_exclusions(conn, user_id, index)
+        with self._lock:
+            if generation < self._changed.get(user_id, self._forgotten_generation):
+                return entry
+            self._entries[user_id] = entry
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_users:
+                self._entries.popitem(last=False)
+        return entry
+
+    # Updates a cached user in place after their watch history for a movie changed.
+    def update(self, user_id, movie_id, watched, ignored):
+        with self._lock:
+            self._record_change(user_id)
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return
+            if movie_id in entry.index:
+                entry.set_flags(entry.index.position_of(movie_id), watched, ignored)
+            else:
+                # The movie is newer than the index, so the entry is reloaded along with the next index.
+                del self._entries[user_id]
+
+    def drop(self, user_id):
+        with self._lock:
+            self._record_change(user_id)
+            self._entries.pop(user_id, None)
+
+    # Called with the lock held, before the user's entry is changed or dropped.
+    def _record_change(self, user_id):
+        self.generation += 1
+        self._changed[user_id] = self.generation
+        self._changed.move_to_end(user_id)
+        while len(self._changed) > REMEMBERED_CHANGES:
+            self._forgotten_generation = self._changed.popitem(last=False)[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "users": len(self._entries)}
+
+
+# Reads the watched and ignored movies of a user from the database into bitmaps.
+def load_user_exclusions(conn, user_id, index):
+    rows = conn.execute("SELECT wh.movie_id, wh.watched, wh.ignored "
+                        "FROM watch_history wh "
+                        "WHERE wh.user_id = ? AND (wh.watched = 1 OR wh.ignored = 1)", (user_id,)).fetchall()
+    watched = np.zeros(len(index), dtype=bool)
+    ignored = np.zeros(len(index), dtype=bool)
+    watched[index.positions_of([row[0] for row in rows if row[1] == 1])] = True
+    ignored[index.positions_of([row[0] for row in rows if row[2] == 1])] = True
+    return UserExclusions(index, np.packbits(watched), np.packbits(ignored))
+
+
+# The cache shared by everything in this process.
+_cache = ExclusionCache()
+
+
+def get_user_exclusions(conn, user_id, index):
+    return _cache.get(conn, user_id, index)
+
+
+def record_watch_history(user_id, movie_id, watched, ignored):
+    _cache.update(user_id, movie_id, watched, ignored)
+
+
+def forget_user(user_id):
+    _cache.drop(user_id)
+
+
+instrumentation.register_collector("exclusion_cache", _cache.stats)
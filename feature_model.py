@@ -0,0 +1,152 @@
+import json
+import re
+
+import numpy as np
+from scipy import sparse
+
+# Weight of every field in the similarity of two movies. Each field is scaled to unit length before its weight is
+# applied, so a weight is the share a field can take in the final vector regardless of how many terms it has.
+FIELD_WEIGHTS = {
+    "tags": 1.0,
+    "genre": 0.6,
+    "director": 0.5,
+    "star": 0.5,
+    "year": 0.25,
+    "rating": 0.15,
+    "meta_score": 0.15,
+}
+
+# The movies columns the features are built from, in the order feature rows list them.
+FEATURE_COLUMNS = ['similarity_tags', 'genre', 'director', 'star1', 'star2', 'star3', 'star4', 'year', 'imdb_rating',
+                   'meta_score']
+
+# Every term is named after its field, as in "genre:drama" or "director:frank darabont".
+FIELD_SEPARATOR = ':'
+
+NUMBER = re.compile(r'\d+(\.\d+)?')
+
+
+# Turns feature rows, with the columns of FEATURE_COLUMNS, into one list of field-prefixed terms per movie.
+# Tags are split like before, genres, the director and the stars become one term each, and the year, IMDB rating and
+# meta score are bucketed by decade, half point and ten points, so nearby values share a term.
+def movie_terms(feature_rows):
+    # sklearn is only imported here, when an index is built or updated, since importing it slows down startup.
+    from sklearn.feature_extraction.text import CountVectorizer
+    analyzer = CountVectorizer(stop_words='english').build_analyzer()
+
+    terms = []
+    for tags, genre, director, star1, star2, star3, star4, year, rating, meta_score in feature_rows:
+        movie = ['tags:' + term for term in analyzer(tags or '')]
+        movie += ['genre:' + name.strip().lower() for name in (genre or '').split(',') if name.strip()]
+        movie += ['director:' + director.strip().lower()] if director and director.strip() else []
+        movie += ['star:' + star.strip().lower() for star in (star1, star2, star3, star4) if star and star.strip()]
+        movie += [field + ':' + bucket for field, bucket in (("year", _bucket(year, 10, "s")),
+                                                             ("rating", _bucket(rating, 0.5)),
+                                                             ("meta_score", _bucket(meta_score, 10)))
+                  if bucket is not None]
+        terms.append(movie)
+    return terms
+
+
+# Returns the bucket of a numeric column as text, or None when the value is missing or not a number.
+def _bucket(value, width, suffix=""):
+    match = NUMBER.search(str(value)) if value is not None else None
+    if match is None:
+        return None
+    return format(np.floor(float(match.group()) / width) * width, 'g') + suffix
+
+
+# Maps movie terms to weighted, L2-normalized sparse vectors. Terms are weighted by their inverse document frequency,
+# the terms of each field are scaled to unit length and multiplied by the field's weight, and the whole vector is
+# normalized again, so cosine similarity stays a single dot product.
+class FeatureModel:
+    def __init__(self, vocabulary, idf, field_weights):
+        # The vocabulary may be a memory-mapped array. It only becomes a list, along with the dictionary of columns,
+        # once terms are looked up or added, so loading a model does not read every term.
+        self.vocabulary = vocabulary
+        self.idf = np.asarray(idf, dtype=np.float32)
+        self.field_weights = dict(field_weights)
+        self.fields = sorted(self.field_weights)
+        self._column_map = None
+
+    @property
+    def _columns(self):
+        if self._column_map is None:
+            self.vocabulary = self.vocabulary.tolist() if isinstance(self.vocabulary, np.ndarray) \
+                else list(self.vocabulary)
+            self._column_map = {term: column for column, term in enumerate(self.vocabulary)}
+        return self._column_map
+
+    # Appends the terms a model has never seen, with an inverse document frequency estimated from the given movies
+    # within a catalog of document_count movies. Existing terms keep their columns and weights.
+    def add_terms(self, terms, document_count):
+        counts = {}
+        for movie in terms:
+            for term in set(movie):
+                if term not in self._columns:
+                    counts[term] = counts.get(term, 0) + 1
+
+        for term, count in counts.items():
+            self._columns[term] = len(self.vocabulary)
+            self.vocabulary.append(term)
+        self.idf = np.concatenate((self.idf, _idf(np.array(list(counts.values())), document_count)))
+
+    def transform(self, terms, dtype=np.float32):
+        rows, columns = [], []
+        for row, movie in enumerate(terms):
+            for term in movie:
+                column = self._columns.get(term)
+                if column is not None:
+                    rows.append(row)
+                    columns.append(column)
+
+        # Duplicate entries are summed into term counts.
+        matrix = sparse.csr_matrix((np.ones(len(rows), dtype=dtype), (rows, columns)),
+                                   shape=(len(terms), len(self.vocabulary)))
+        matrix.sum_duplicates()
+        if matrix.nnz == 0:
+            return matrix
+
+        # Every entry is weighted by its term's IDF, then scaled by the length of its movie's field and the field's
+        # weight, using one bincount per normalization instead of slicing the matrix per field.
+        field_numbers = {field: number for number, field in enumerate(self.fields)}
+        # Terms of a field without a weight fall in an extra field weighted 0, so they are dropped.
+        column_fields = np.array([field_numbers.get(term.split(FIELD_SEPARATOR, 1)[0], len(self.fields))
+                                  for term in self.vocabulary], dtype=np.int64)
+        weights = np.array([self.field_weights[field] for field in self.fields] + [0.0], dtype=dtype)
+
+        entry_rows = np.repeat(np.arange(len(terms)), np.diff(matrix.indptr))
+        entry_fields = column_fields[matrix.indices]
+        values = matrix.data * self.idf[matrix.indices]
+
+        groups = entry_rows * (len(self.fields) + 1) + entry_fields
+        field_norms = np.sqrt(np.bincount(groups, weights=values ** 2))
+        values = values / field_norms[groups] * weights[entry_fields]
+
+        row_norms = np.sqrt(np.bincount(entry_rows, weights=values ** 2, minlength=len(terms)))
+        matrix.data = (values / np.where(row_norms > 0, row_norms, 1)[entry_rows]).astype(dtype)
+        matrix.eliminate_zeros()
+        return matrix
+
+    def weights_key(self):
+        return weights_key(self.field_weights)
+
+
+# Builds a model from the terms of every movie in the catalog.
+def fit_feature_model(terms, field_weights=None):
+    vocabulary = sorted({term for movie in terms for term in movie})
+    columns = {term: column for column, term in enumerate(vocabulary)}
+    document_frequency = np.bincount(np.array([columns[term] for movie in terms for term in set(movie)],
+                                              dtype=np.int64), minlength=len(vocabulary))
+    return FeatureModel(vocabulary, _idf(document_frequency, len(terms)), field_weights or FIELD_WEIGHTS)
+
+
+# The field weights as stored with an index, so an index built with other weights is never reused.
+def weights_key(field_weights=None):
+    return json.dumps(field_weights or FIELD_WEIGHTS, sort_keys=True)
+
+
+# Smoothed inverse document frequency, as computed by sklearn's TfidfTransformer.
+def _idf(document_frequency, document_count):
+    return (np.log((1 + document_count) / (1 + np.asarray(document_frequency, dtype=np.float64))) + 1).astype(
+        np.float32)
@@ -0,0 +1,325 @@
+import bisect
+import cProfile
+import io
+import json
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+# Instrumentation is off unless the MOVIE_RECOMMENDER_METRICS environment variable is set or enable() is called. While
+# off, span() hands out one shared no-op context manager and the record functions return at their first line, so the
+# calls can stay in the hot paths.
+ENABLED = os.environ.get("MOVIE_RECOMMENDER_METRICS", "") not in ("", "0")
+
+# Upper bounds, in seconds, of the latency histogram buckets exported to Prometheus.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Prefix of every exported Prometheus metric.
+METRIC_PREFIX = "movie_recommender_"
+
+# Number of functions listed in a captured profile, by cumulative time.
+PROFILE_FUNCTIONS = 25
+
+# Number of source lines listed in a captured memory report, by allocated size.
+MEMORY_LINES = 10
+
+
+# The count, sum and maximum of a measured quantity, with a histogram when buckets are given.
+class Summary:
+    def __init__(self, buckets=None):
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+        self.buckets = buckets
+        # One count per bucket, plus one for values above the last bound.
+        self.bucket_counts = [0] * (len(buckets) + 1) if buckets else None
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.maximum = max(self.maximum, value)
+        if self.buckets:
+            self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+
+    def to_dict(self):
+        return {"count": self.count, "total": round(self.total, 6),
+                "mean": round(self.total / self.count, 6) if self.count else 0.0, "max": round(self.maximum, 6)}
+
+
+# Time spent in SQL statements: the execute calls, the fetches that follow and the rows they return.
+class StatementStats:
+    def __init__(self):
+        self.execute = Summary(LATENCY_BUCKETS)
+        self.fetch_seconds = 0.0
+        self.rows = 0
+
+    def to_dict(self):
+        return dict(self.execute.to_dict(), fetch_total=round(self.fetch_seconds, 6), rows=self.rows)
+
+
+class _Span:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exception):
+        record_span(self.name, time.perf_counter() - self.start)
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+_spans = {}
+_values = {}
+_counters = {}
+_statements = {}
+_collectors = {}
+_lock = threading.Lock()
+
+# Requests captured by capture() record their spans and statements in a per-thread trace, even with instrumentation
+# off. _capturing counts the captures running in any thread, so span() only looks at the thread when one is.
+_capturing = 0
+_local = threading.local()
+
+
+def enable():
+    global ENABLED
+    ENABLED = True
+
+
+def disable():
+    global ENABLED
+    ENABLED = False
+
+
+# Returns a context manager timing the block it wraps under the given name, as in
+# "with instrumentation.span('similar.catalog'):".
+def span(name):
+    if not ENABLED and not _capturing:
+        return _NO_SPAN
+    return _Span(name)
+
+
+def record_span(name, seconds):
+    trace = getattr(_local, "trace", None) if _capturing else None
+    if trace is not None:
+        trace.append({"span": name, "ms": round(seconds * 1000, 3)})
+    if not ENABLED:
+        return
+    with _lock:
+        summary = _spans.get(name)
+        if summary is None:
+            summary = _spans[name] = Summary(LATENCY_BUCKETS)
+        summary.add(seconds)
+
+
+# Records a measured size, such as the number of candidates scored or the nonzeros of a sparse product.
+def record_value(name, value):
+    if not ENABLED:
+        return
+    with _lock:
+        summary = _values.get(name)
+        if summary is None:
+            summary = _values[name] = Summary()
+        summary.add(value)
+
+
+def count(name, amount=1):
+    if not ENABLED:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+# Records one execution of a SQL statement. The time and rows of the fetches that follow it are added with
+# record_sql_fetch.
+def record_sql(statement, seconds, rows=0):
+    trace = getattr(_local, "trace", None) if _capturing else None
+    if trace is not None:
+        trace.append({"sql": " ".join(statement.split()), "ms": round(seconds * 1000, 3)})
+    if not ENABLED:
+        return
+    with _lock:
+        stats = _statements.get(statement)
+        if stats is None:
+            stats = _statements[statement] = StatementStats()
+        stats.execute.add(seconds)
+        stats.rows += rows
+
+
+def record_sql_fetch(statement, seconds, rows):
+    if not ENABLED or statement is None:
+        return
+    with _lock:
+        stats = _statements.get(statement)
+        if stats is None:
+            stats = _statements[statement] = StatementStats()
+        stats.fetch_seconds += seconds
+        stats.rows += rows
+
+
+# Adds a function whose dictionary of numbers, such as a cache's counters, is exported along with the metrics.
+def register_collector(name, function):
+    _collectors[name] = function
+
+
+def reset():
+    with _lock:
+        _spans.clear()
+        _values.clear()
+        _counters.clear()
+        _statements.clear()
+
+
+# Tells whether the current thread is inside capture().
+def capturing():
+    return _capturing > 0 and getattr(_local, "trace", None) is not None
+
+
+# Profiles the block it wraps in the current thread with cProfile and tracemalloc, and fills the dictionary it yields
+# with the block's duration, its spans and SQL statements in order, its most expensive functions and its peak memory.
+# Statements are recorded on connections checked out inside the block, which the pool opens as timed connections.
+# tracemalloc sees every thread, so the memory figures also count requests running at the same time.
+@contextmanager
+def capture(profile=True, memory=True):
+    global _capturing
+    report = {}
+    _local.trace = []
+    with _lock:
+        _capturing += 1
+
+    profiler = cProfile.Profile() if profile else None
+    trace_memory = memory and not tracemalloc.is_tracing()
+    if trace_memory:
+        tracemalloc.start()
+    if profiler is not None:
+        profiler.enable()
+    start = time.perf_counter()
+    try:
+        yield report
+    finally:
+        report["ms"] = round((time.perf_counter() - start) * 1000, 3)
+        if profiler is not None:
+            profiler.disable()
+            output = io.StringIO()
+            pstats.Stats(profiler, stream=output).sort_stats("cumulative").print_stats(PROFILE_FUNCTIONS)
+            report["profile"] = output.getvalue()
+        if trace_memory:
+            snapshot = tracemalloc.take_snapshot()
+            report["peak_memory_bytes"] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            report["memory"] = [str(statistic) for statistic in snapshot.statistics("lineno")[:MEMORY_LINES]]
+        report["trace"] = _local.trace
+        _local.trace = None
+        with _lock:
+            _capturing -= 1
+
+
+# Returns every metric as a dictionary of plain numbers.
+def snapshot():
+    with _lock:
+        result = {"enabled": ENABLED,
+                  "spans": {name: summary.to_dict() for name, summary in sorted(_spans.items())},
+                  "values": {name: summary.to_dict() for name, summary in sorted(_values.items())},
+                  "counters": dict(sorted(_counters.items())),
+                  "sql": {" ".join(statement.split()): stats.to_dict()
+                          for statement, stats in sorted(_statements.items())}}
+    result.update({name: function() for name, function in _collectors.items()})
+    return result
+
+
+# Returns every metric in the Prometheus text exposition format.
+def prometheus_text():
+    with _lock:
+        spans = sorted(_spans.items())
+        values = sorted(_values.items())
+        counters = sorted(_counters.items())
+        statements = sorted(_statements.items())
+
+    lines = []
+    _histogram_lines(lines, "span_seconds", "span", spans)
+    _histogram_lines(lines, "sql_execute_seconds", "statement",
+                     [(statement, stats.execute) for statement, stats in statements])
+
+    for metric, pairs in (("sql_fetch_seconds_total", [(statement, stats.fetch_seconds)
+                                                       for statement, stats in statements]),
+                          ("sql_rows_total", [(statement, stats.rows) for statement, stats in statements])):
+        lines.append("# TYPE " + METRIC_PREFIX + metric + " counter")
+        lines += [METRIC_PREFIX + metric + _labels(statement=statement) + " " + _number(value)
+                  for statement, value in pairs]
+
+    lines.append("# TYPE " + METRIC_PREFIX + "value summary")
+    for name, summary in values:
+        lines.append(METRIC_PREFIX + "value_sum" + _labels(name=name) + " " + _number(summary.total))
+        lines.append(METRIC_PREFIX + "value_count" + _labels(name=name) + " " + _number(summary.count))
+    lines.append("# TYPE " + METRIC_PREFIX + "value_max gauge")
+    lines += [METRIC_PREFIX + "value_max" + _labels(name=name) + " " + _number(summary.maximum)
+              for name, summary in values]
+
+    lines.append("# TYPE " + METRIC_PREFIX + "events_total counter")
+    lines += [METRIC_PREFIX + "events_total" + _labels(name=name) + " " + _number(value) for name, value in counters]
+
+    # Collected numbers are exported as gauges named after their collector, with nested keys joined by underscores.
+    for name, function in sorted(_collectors.items()):
+        for key, value in _flatten(function(), name):
+            lines.append("# TYPE " + METRIC_PREFIX + key + " gauge")
+            lines.append(METRIC_PREFIX + key + " " + _number(value))
+    return "\n".join(lines) + "\n"
+
+
+# Writes the metrics to a file, in the Prometheus text format if its name ends in .prom and as JSON otherwise.
+# The file is replaced in one step, so a collector reading it never sees half of it.
+def write_metrics(path):
+    text = prometheus_text() if path.endswith(".prom") else json.dumps(snapshot(), indent=2)
+    temporary_path = path + ".tmp"
+    with open(temporary_path, 'w') as file:
+        file.write(text)
+    os.replace(temporary_path, path)
+
+
+def _histogram_lines(lines, metric, label, summaries):
+    lines.append("# TYPE " + METRIC_PREFIX + metric + " histogram")
+    for name, summary in summaries:
+        # Prometheus buckets are cumulative, each counting the values up to its bound.
+        cumulative = 0
+        for bound, bucket_count in zip(LATENCY_BUCKETS + ("+Inf",), summary.bucket_counts):
+            cumulative += bucket_count
+            lines.append(METRIC_PREFIX + metric + "_bucket" + _labels(**{label: name, "le": str(bound)}) + " " +
+                         str(cumulative))
+        lines.append(METRIC_PREFIX + metric + "_sum" + _labels(**{label: name}) + " " + _number(summary.total))
+        lines.append(METRIC_PREFIX + metric + "_count" + _labels(**{label: name}) + " " + str(summary.count))
+
+
+def _labels(**labels):
+    return "{" + ",".join(key + '="' + " ".join(str(value).split()).replace("\\", "\\\\").replace('"', '\\"') + '"'
+                          for key, value in labels.items()) + "}"
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _flatten(values, prefix):
+    for key, value in sorted(values.items()):
+        name = prefix + "_" + "".join(character if character.isalnum() else "_" for character in str(key))
+        if isinstance(value, dict):
+            yield from _flatten(value, name)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield name, value
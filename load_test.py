@@ -0,0 +1,130 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import database
+import server
+import sqlite_functions
+import synthetic_data
+
+# Share of each action in the generated traffic.
+ACTION_MIX = {
+    "search": 0.3,
+    "similar_movies": 0.3,
+    "history_recommendations": 0.2,
+    "watch_history": 0.1,
+    "update_history": 0.1,
+}
+
+
+# Returns a random request of the given action for one of the users.
+def random_request(rng, action, user_ids, movies):
+    user_id = rng.choice(user_ids)
+    movie_id, title = rng.choice(movies)
+    if action == "search":
+        return {"action": action, "user_id": user_id, "query": title.split()[0]}
+    if action == "similar_movies":
+        return {"action": action, "user_id": user_id, "movie_id": movie_id}
+    if action == "update_history":
+        watched = rng.random() < 0.7
+        return {"action": action, "user_id": user_id, "movie_id": movie_id, "watched": watched,
+                "liked": watched and rng.random() < 0.5, "ignored": not watched and rng.random() < 0.3}
+    return {"action": action, "user_id": user_id}
+
+
+# Sends requests one after another over a single connection, like one user would, recording each latency.
+async def run_client(host, port, requests, latencies, errors):
+    reader, writer = await asyncio.open_connection(host, port, limit=server.MAX_REQUEST_BYTES)
+    try:
+        for request in requests:
+            start = time.perf_counter()
+            writer.write(json.dumps(request).encode() + b"\n")
+            await writer.drain()
+            response = json.loads(await reader.readline())
+            latencies[request["action"]].append(time.perf_counter() - start)
+            if "error" in response:
+                errors.append(request["action"] + ": " + response["error"])
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+
+# Runs the given number of concurrent clients against a server and returns the throughput and latency percentiles of
+# every action.
+async def load_test(host, port, user_ids, movies, connections, request_count, seed=0):
+    rng = random.Random(seed)
+    actions = rng.choices(list(ACTION_MIX), weights=list(ACTION_MIX.values()), k=request_count)
+    requests = [random_request(rng, action, user_ids, movies) for action in actions]
+
+    latencies = {action: [] for action in ACTION_MIX}
+    errors = []
+    start = time.perf_counter()
+    await asyncio.gather(*(run_client(host, port, requests[number::connections], latencies, errors)
+                           for number in range(connections)))
+    elapsed = time.perf_counter() - start
+
+    report = {"connections": connections, "requests": request_count, "seconds": round(elapsed, 3),
+              "requests_per_second": round(request_count / elapsed, 1), "errors": len(errors), "actions": {}}
+    for action, values in latencies.items():
+        if values:
+            values = np.array(values) * 1000
+            report["actions"][action] = {"requests": len(values),
+                                         "p50_ms": round(float(np.percentile(values, 50)), 3),
+                                         "p95_ms": round(float(np.percentile(values, 95)), 3),
+                                         "p99_ms": round(float(np.percentile(values, 99)), 3)}
+    if errors:
+        report["first_errors"] = errors[:5]
+    return report
+
+
+# Builds a synthetic database, starts server.py on it in another process and load tests it.
+def run(movie_count, user_count, history_size, connections, request_count, workers, seed=0):
+    with tempfile.TemporaryDirectory() as directory:
+        database_path = os.path.join(directory, "load-test.db")
+        database.configure(database_path)
+        sqlite_functions.generate_tables()
+        with database.connection() as conn:
+            user_ids = synthetic_data.populate_database(conn, movie_count, user_count, history_size, seed)
+            movies = conn.execute("SELECT id, title FROM movies").fetchall()
+        database.configure()
+
+        process = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                 "server.py"),
+                                    "--database", database_path, "--port", "0", "--workers", str(workers)],
+                                   stdout=subprocess.PIPE, text=True)
+        try:
+            # The server prints its address once the similarity index is loaded.
+            address = process.stdout.readline().strip().rsplit(" ", 1)[-1]
+            if not address:
+                raise RuntimeError("The server did not start.")
+            host, port = address.rsplit(":", 1)
+            return asyncio.run(load_test(host, int(port), user_ids, movies, connections, request_count, seed))
+        finally:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load tests server.py with many concurrent clients.")
+    parser.add_argument("--movies", type=int, default=10000)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--history", type=int, default=50, help="watch history rows per user")
+    parser.add_argument("--connections", type=int, default=50, help="concurrent clients")
+    parser.add_argument("--requests", type=int, default=5000, help="requests sent in total")
+    parser.add_argument("--workers", type=int, default=server.WORKERS, help="server threads running requests")
+    parser.add_argument("--output", help="JSON file the report is written to")
+    args = parser.parse_args()
+
+    result = run(args.movies, args.users, args.history, args.connections, args.requests, args.workers)
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(result, file, indent=2)
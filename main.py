@@ -1,15 +1,21 @@
-import sqlite3
+import time
+
+_imports_started = time.perf_counter()
 
-import numpy as np
+import argparse
+import sqlite3
 
+import instrumentation
 import movie_recommender_functions
 import sqlite_functions
-import pandas as pd
+
+IMPORT_SECONDS = time.perf_counter() - _imports_started
 
 
 def main():
     sqlite_functions.generate_tables()
     sqlite_functions.load_movie_data()
+    movie_recommender_functions.load_similarity_index()
     print("Welcome to the Movie Browser System.")
 
     # current_user is a tuple for user ID, username, and last active.
@@ -49,19 +55,11 @@ def main():
 
         elif selected_menu_number == "3":
             watch_history = sqlite_functions.get_watch_history(current_user[0])
-            history_df = pd.DataFrame(watch_history,
-                                      columns=['id', '-Movie Title-', '-Watched-', '-Liked-', '-Ignored-'])
-            if history_df.empty:
+            if len(watch_history) == 0:
                 print('No watch history for "' + username + '".')
             else:
-                history_df.index = np.arange(1, len(history_df) + 1)  # This line sets the indexes to begin from 1.
-
-                # Replaces all 1 and 0 in the latter 3 columns with yes and no for improved readability.
-                history_df = history_df.replace({1: 'yes', 0: 'no'})
-
                 print('\nHere is the watch history for "' + username + '":')
-                # The following prints all columns except the movie's ID.
-                print(history_df[['-Movie Title-', '-Watched-', '-Liked-', '-Ignored-']])
+                print_watch_history(watch_history)
 
                 if input("Would you like to edit items in watch history? Enter y to confirm: ") == "y":
                     selected_index = get_valid_int_input(len(watch_history))
@@ -78,6 +76,43 @@ def main():
             user_logged_in = False
 
 
+# Prints every column except the movie's ID as a table, numbered from 1 and with yes and no instead of 1 and 0.
+def print_watch_history(watch_history):
+    headers = ['-Movie Title-', '-Watched-', '-Liked-', '-Ignored-']
+    rows = [[row[1]] + ['yes' if flag == 1 else 'no' for flag in row[2:5]] for row in watch_history]
+    number_width = len(str(len(rows)))
+    widths = [max(len(str(value)) for value in column) for column in zip(headers, *rows)]
+
+    print(' ' * number_width, '  '.join(header.rjust(width) for header, width in zip(headers, widths)))
+    for index, row in enumerate(rows, start=1):
+        print(str(index).ljust(number_width), '  '.join(value.rjust(width) for value, width in zip(row, widths)))
+
+
+# Reports how long the program takes to import its modules and to answer its first queries, so that cold start
+# can be tracked. The timings are printed as one "stage: milliseconds" line each.
+def report_startup_timing():
+    timings = [("imports", IMPORT_SECONDS)]
+
+    def measure(stage, function, *args):
+        started = time.perf_counter()
+        result = function(*args)
+        timings.append((stage, time.perf_counter() - started))
+        return result
+
+    measure("generate_tables", sqlite_functions.generate_tables)
+    measure("load_movie_data", sqlite_functions.load_movie_data)
+    measure("load_similarity_index", movie_recommender_functions.load_similarity_index)
+
+    # User 0 never exists, so the first queries run without any watch history.
+    results = measure("first search", sqlite_functions.select_movie, "the", 0)
+    if results:
+        measure("first recommendation", movie_recommender_functions.get_recommended_movies, results[0][0], 0, 6)
+    measure("first watch history recommendation", movie_recommender_functions.recommend_based_on_watch_history, 0)
+
+    for stage, seconds in timings:
+        print(stage + ": " + format(seconds * 1000, ".1f") + " ms")
+
+
 def manage_users():
     while True:
         print("To create a new user, enter 1.")
@@ -243,4 +278,35 @@ def handle_user_movie_selection(user_id, movie_id, movie_title):
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description="Movie Browser System")
+    parser.add_argument("--import", dest="import_csvs", nargs="+", metavar="CSV",
+                        help="add new movies and update changed ones from CSV files, then exit")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="number of worker processes used to clean tags when importing")
+    parser.add_argument("--startup-timing", action="store_true",
+                        help="report import and first query latency, then exit")
+    parser.add_argument("--memory-mapped-catalog", action="store_true",
+                        help="save the similarity index as a catalog that is memory-mapped when loaded, then exit")
+    parser.add_argument("--metrics", metavar="FILE",
+                        help="enable instrumentation and write its metrics to FILE on exit, as Prometheus text if it "
+                             "ends in .prom and as JSON otherwise")
+    args = parser.parse_args()
+
+    if args.metrics:
+        instrumentation.enable()
+    try:
+        if args.startup_timing:
+            report_startup_timing()
+        elif args.import_csvs:
+            sqlite_functions.generate_tables()
+            updated_movie_ids = sqlite_functions.upsert_movie_data(args.import_csvs, args.processes)
+            print("Imported " + str(len(updated_movie_ids)) + " new or changed movies.")
+        elif args.memory_mapped_catalog:
+            sqlite_functions.generate_tables()
+            sqlite_functions.load_movie_data()
+            print("Saved the catalog to " + movie_recommender_functions.export_memory_mapped_catalog() + ".")
+        else:
+            main()
+    finally:
+        if args.metrics:
+            instrumentation.write_metrics(args.metrics)
@@ -1,86 +1,199 @@
 import random
-import sqlite3
-import pandas as pd
 
-from sklearn.feature_extraction.text import CountVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
-
-
-# This function vectorizes the text and then calculates the cosine similarity.
-def calculate_cosine_similarity(dataframe):
-    cv = CountVectorizer(max_features=10000, stop_words='english')
-    vectorized_text = cv.fit_transform(dataframe['similarity_tags'].values.astype('U')).toarray()
-    return cosine_similarity(vectorized_text)
-
-
-# This function returns a list of recommended movies for a given user.
-def get_recommended_movies(movie_id, user_id, quantity):
-    conn = sqlite3.connect("movie-records.db")
-    
-    # This query will select all movies except those that the user has ignored and/or already watched.
-    # The searched movie is also needed when calculating similarities, so that one is also retrieved.
-    df = pd.read_sql('SELECT m.* '
-                     'FROM movies m '
-                     'WHERE m.id = :movie_id '
-                     'OR NOT EXISTS (SELECT wh.movie_id '
-                     'FROM watch_history wh '
-                     'WHERE m.id = wh.movie_id AND user_id = :user_id AND (wh.watched = 1 OR wh.ignored = 1)) ',
-                     con=conn, params={"movie_id": movie_id, "user_id": user_id})
+import numpy as np
+
+import ann_index
+import database
+import exclusion_cache
+import instrumentation
+import result_cache
+import similarity_index
+
+# Recommendations based on watch history weight each liked movie by how recently it was liked.
+# A like loses half of its weight every RECENCY_HALF_LIFE_DAYS days.
+RECENCY_HALF_LIFE_DAYS = 30
+
+# When the neighbor table cannot answer a lookup, only score the candidates found by the approximate nearest-neighbor
+# index instead of the whole catalog. ann_index.PROBES trades recall for speed.
+USE_ANN_INDEX = False
+
+
+# Loads the similarity index at startup so the first recommendation does not pay for building or reading it.
+def load_similarity_index():
+    with database.connection() as conn:
+        similarity_index.get_similarity_index(conn)
+
+
+# Saves the similarity index as a memory-mapped catalog as well. It is kept up to date from then on, and preferred over
+# the .npz file when the index is loaded.
+def export_memory_mapped_catalog():
+    with database.connection() as conn:
+        index = similarity_index.get_similarity_index(conn)
+    similarity_index.MEMORY_MAPPED_CATALOG = True
+    similarity_index.save_similarity_index(index)
+    return similarity_index.catalog_path()
+
+
+# This function returns the IDs, titles and similarity scores of the recommended movies for a given user, best first.
+# Movies scoring below min_score are left out, so fewer than quantity movies may be returned.
+def get_recommended_movies(movie_id, user_id, quantity, min_score=None):
+    with database.connection() as conn:
+        index = similarity_index.get_similarity_index(conn)
+
+        # A user browsing the same movies again gets their cached results, until their watch history changes.
+        key = (user_id, "similar", movie_id, quantity, min_score)
+        cached = result_cache.user_cache.get(key, index)
+        if cached is not None:
+            positions, scores = cached
+            return index.movie_ids[positions].tolist(), index.titles[positions].tolist(), scores.tolist()
+        generation = result_cache.user_cache.generation
+
+        # Movies the user has watched or ignored are never recommended. The mask comes from a per-user cache.
+        with instrumentation.span("similar.exclusions"):
+            excluded = exclusion_cache.get_user_exclusions(conn, user_id, index).excluded_mask()
+
+    positions, scores = similar_movie_positions(index, movie_id, excluded, quantity, min_score)
+    result_cache.user_cache.put(key, index, (positions, scores), generation)
+
+    # The .tolist() call is to get int and float values instead of the np int64 and float32 types.
+    return index.movie_ids[positions].tolist(), index.titles[positions].tolist(), scores.tolist()
+
+
+# Returns the index positions and scores of the movies most similar to a movie, best first, skipping the excluded ones.
+def similar_movie_positions(index, movie_id, excluded, quantity, min_score=None):
+    # The precomputed neighbor table answers most lookups directly, as long as enough neighbors survive the exclusions.
+    # A table built by ann_index is approximate, so it is only used once approximate lookups are allowed too.
+    if index.neighbor_ids is not None and (USE_ANN_INDEX or not index.approximate_neighbors):
+        instrumentation.count("similar.neighbor_table.lookups")
+        position = index.position_of(movie_id)
+        neighbors = index.neighbor_ids[position]
+        neighbor_scores = index.neighbor_scores[position]
+        # An ID of -1 pads the lists of movies with fewer stored neighbors than the table holds.
+        # Every other neighbor is in the index, so its position is found with a binary search.
+        kept = (neighbors >= 0) & ~excluded[np.searchsorted(index.movie_ids, neighbors)]
+        if min_score is not None:
+            kept &= neighbor_scores >= min_score
+
+        # Neighbors are sorted by score, so a threshold cut inside the table means no other movie can pass it either.
+        # An approximate table may have missed movies scoring above its last neighbor, so it never ends the lookup
+        # on its own.
+        threshold_reached = (not index.approximate_neighbors and min_score is not None and len(neighbor_scores) > 0
+                             and -np.inf < neighbor_scores[-1] < min_score)
+        if np.count_nonzero(kept) >= quantity or threshold_reached:
+            instrumentation.count("similar.neighbor_table.answered")
+            return index.positions_of(neighbors[kept][:quantity]), neighbor_scores[kept][:quantity]
+
+    # Otherwise, the movie is scored against the candidates of the ANN index, if enabled, as long as enough of them
+    # survive the exclusions.
+    if USE_ANN_INDEX:
+        with instrumentation.span("similar.ann"):
+            candidates, scores = ann_index.get_ann_index(index).similarity_scores(index, movie_id)
+            scores[excluded[candidates] | (candidates == index.position_of(movie_id))] = -np.inf
+            top = similarity_index.top_k_positions(scores, quantity, min_score)
+        instrumentation.record_value("similar.ann.candidates", len(candidates))
+        if len(top) >= quantity:
+            instrumentation.count("similar.ann.answered")
+            return candidates[top], scores[top]
+
+    # Otherwise, the movie's neighbors over the whole catalog come from a cache shared by every user. A user who
+    # excluded too many of them gets a list deep enough to skip every excluded movie, scored once and cached instead.
+    instrumentation.count("similar.catalog.answered")
+    depth = result_cache.NEIGHBOR_CACHE_DEPTH
+    while True:
+        positions, scores = result_cache.movie_neighbors(index, movie_id, depth)
+        kept = ~excluded[positions]
+        if min_score is not None:
+            kept &= scores >= min_score
+
+        complete = len(positions) < depth or (min_score is not None and len(scores) > 0 and scores[-1] < min_score)
+        if np.count_nonzero(kept) >= quantity or complete:
+            return positions[kept][:quantity], scores[kept][:quantity]
+        depth = quantity + np.count_nonzero(excluded)
+
+
+# This function recommends movies similar to everything the user liked, scoring all liked movies in a single pass.
+# The aggregation can be "sum", "max" or "recency" (a sum where recent likes count more).
+def recommend_based_on_watch_history(user_id, aggregation="recency", quantity=6):
+    with database.connection() as conn:
+        index = similarity_index.get_similarity_index(conn)
+
+        # Only the random draw below runs again for a user whose candidates are cached. They are scored again once
+        # the user's watch history changes.
+        key = (user_id, "history", aggregation, quantity)
+        candidates = result_cache.user_cache.get(key, index)
+        if candidates is None:
+            generation = result_cache.user_cache.generation
+            with instrumentation.span("history.candidates"):
+                candidates = history_candidates(conn, index, user_id, aggregation, quantity)
+            result_cache.user_cache.put(key, index, candidates, generation)
+    pool, reasons, top_ten_positions = candidates
+    rec_list = []
 
-    quantity += 1  # Quantity is incremented once since we always skip the first result, which is the searched movie.
+    # A pool twice the requested size is kept, and a random sample of it is recommended, so that the same
+    # recommended movies do not appear every time.
+    for number in random.sample(range(len(pool)), min(quantity, len(pool))):
+        # This appends the recommended movie's title, the reason for the recommendation, and the movie's ID.
+        rec_list.append([index.titles[pool[number]].item(),
+                         ' similar to movie "' + index.titles[reasons[number]].item() + '".',
+                         index.movie_ids[pool[number]].item()])
 
-    # Find the index of the given movie in the DataFrame
-    index = df[df['id'] == movie_id].index[0]
+    if len(rec_list) < quantity:
+        # This IF fills in any remaining list slots with random top ten movies after excluding ignored ones.
+        limit = quantity - len(rec_list)
+        recommended_ids = {rec[2] for rec in rec_list}
 
-    # Calculate similarity scores and then puts them into a sorted list of descending similarity.
-    similarity = calculate_cosine_similarity(df)
-    distance = sorted(list(enumerate(similarity[index])), reverse=True, key=lambda vector: vector[1])
+        top_ten_movies = [[index.movie_ids[position].item(), index.titles[position].item()]
+                          for position in top_ten_positions if index.movie_ids[position] not in recommended_ids]
+        random.shuffle(top_ten_movies)
 
-    # Gets the movie IDs and titles
-    # The .item() call is to get the int value instead of the np int64 type.
-    movie_ids = [df.iloc[i[0]].id.item() for i in distance[1:quantity]]
-    titles = [df.iloc[i[0]].title for i in distance[1:quantity]]
+        for movie in top_ten_movies[:limit]:
+            rec_list.append([movie[1], " because it's a top ten movie.", movie[0]])
 
-    return movie_ids, titles
+    # The list is shuffled to prevent the exact same recommended movies appearing every time.
+    random.shuffle(rec_list)
+    return rec_list[0:quantity]
 
 
-def recommend_based_on_watch_history(user_id):
-    conn = sqlite3.connect("movie-records.db")
+# Scores every movie the user liked in one batched pass. Returns the index positions of a pool of twice the requested
+# quantity of the best scored movies, the positions of the liked movie that scored each of them best, and the positions
+# of the top ten movies the user has neither watched nor ignored.
+def history_candidates(conn, index, user_id, aggregation, quantity):
     cur = conn.cursor()
     # An inner join is used because we only want rows that have a match on both tables.
-    # The ORDER BY is constructed to select the most recently liked movies, with nulls put at the end (if present).
-    cur.execute("SELECT m.title, m.id "
+    # The age of each like is measured in days, falling back to the creation date for rows never edited.
+    cur.execute("SELECT m.id, julianday('now') - julianday(COALESCE(u.last_edited, u.creation_date)) "
                 "FROM movies m "
                 "INNER JOIN watch_history u ON m.id = u.movie_id "
                 "WHERE u.liked = 1 AND u.ignored = 0 AND u.user_id = ? "
-                "ORDER BY last_edited IS NOT NULL DESC", (user_id,))
-    rec_list = []
-    liked_movies = cur.fetchall()
-
-    for movie in liked_movies:
-        recs = get_recommended_movies(movie[1], user_id, 3)
-
-        for index, rec_movie in enumerate(recs[1]):
-            # This appends the recommended movie's title, the reason for the recommendation, and the movie's ID.
-            rec_list.append([rec_movie, ' similar to movie "' + movie[0] + '".', recs[0][index]])
-
-    if len(rec_list) < 6:
-        # This IF fills in any remaining list slots with random top ten movies after excluding ignored ones.
-        limit = 6 - len(rec_list)
-
-        cur.execute("SELECT m.id, m.title "
-                    "FROM movies m "
-                    "WHERE NOT EXISTS (SELECT wh.movie_id  "
-                    "FROM watch_history wh "
-                    "WHERE m.id = wh.movie_id AND wh.user_id = ? AND (watched = 1 OR ignored = 1)) "
-                    "ORDER BY m.id "
-                    "LIMIT 10", (user_id,))
-        top_ten_movies = cur.fetchall()
-        random.shuffle(top_ten_movies)
-
-        for i in range(limit):
-            rec_list.append([top_ten_movies[i][1], " because it's a top ten movie.", top_ten_movies[i][0]])
-
-    # The list is shuffled to prevent the exact same recommended movies appearing every time.
-    random.shuffle(rec_list)
-    return rec_list[0:6]
+                "ORDER BY m.id", (user_id,))
+    liked_movies = [movie for movie in cur.fetchall() if movie[0] in index]
+    with instrumentation.span("history.exclusions"):
+        excluded = exclusion_cache.get_user_exclusions(conn, user_id, index).excluded_mask()
+    instrumentation.record_value("history.liked_movies", len(liked_movies))
+
+    # The index is ordered by movie ID, so the first positions left unmasked are the top ten movies.
+    top_ten_positions = np.flatnonzero(~excluded)[:10]
+    if not liked_movies:
+        empty = np.array([], dtype=np.int64)
+        return empty, empty, top_ten_positions
+
+    liked_ids = np.array([movie[0] for movie in liked_movies], dtype=np.int64)
+    weights = None
+    if aggregation == "recency":
+        ages = np.array([movie[1] or 0.0 for movie in liked_movies], dtype=np.float64)
+        weights = 0.5 ** (np.maximum(ages, 0.0) / RECENCY_HALF_LIFE_DAYS)
+
+    with instrumentation.span("history.scoring"):
+        scores = index.aggregate_similarity_scores(liked_ids, weights, "max" if aggregation == "max" else "sum")
+
+    # Every candidate appears once in the scores, and the exclusions are applied once for all liked movies.
+    with instrumentation.span("history.top_k"):
+        scores[excluded] = -np.inf
+        scores[index.positions_of(liked_ids)] = -np.inf
+        pool = similarity_index.top_k_positions(scores, quantity * 2, min_score=np.finfo(scores.dtype).tiny)
+
+    # The reason for each recommendation is the liked movie with the best weighted similarity to it, found for the
+    # pool alone.
+    with instrumentation.span("history.reasons"):
+        best_seeds = index.best_seeds(liked_ids, pool, weights)
+    return pool, index.positions_of(liked_ids[best_seeds]), top_ten_positions
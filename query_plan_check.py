@@ -0,0 +1,174 @@
+import argparse
+import csv
+import os
+import re
+import sys
+import tempfile
+
+import batch_recommendations
+import database
+import movie_recommender_functions
+import sqlite_functions
+import synthetic_data
+
+# Tables whose full scans mean a query stopped using its indexes as the catalog and the watch history grow.
+CHECKED_TABLES = {'movies', 'users', 'watch_history', 'user_recommendations'}
+
+# Title of a movie added to the synthetic catalog. Its one word is in hundreds of other titles, and searching for it
+# must still return this movie first.
+COMMON_WORD_TITLE = "Love"
+
+DATA_STATEMENTS = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'REPLACE')
+
+TABLE_REFERENCE = re.compile(r'\b(?:FROM|JOIN|INTO|UPDATE)\s+(\w+)(?:\s+(?:AS\s+)?(?!WHERE|ON|INNER|LEFT|JOIN|ORDER|'
+                             r'GROUP|LIMIT|SET|VALUES|SELECT|DEFAULT)(\w+))?', re.IGNORECASE)
+
+
+# Records the query plan of every statement a connection runs, while it runs.
+class PlanRecorder:
+    def __init__(self, conn):
+        self.conn = conn
+        self.plans = []
+
+    def __call__(self, statement):
+        if not statement.lstrip().upper().startswith(DATA_STATEMENTS):
+            return
+        try:
+            plan = [row[3] for row in self.conn.execute("EXPLAIN QUERY PLAN " + statement)]
+        except Exception as error:
+            plan = ["could not explain: " + str(error)]
+        self.plans.append((statement, plan))
+
+
+# Maps every table alias in a statement to the table it stands for, including the tables themselves.
+def table_aliases(statement):
+    aliases = {}
+    for table, alias in TABLE_REFERENCE.findall(statement):
+        aliases[table.lower()] = table.lower()
+        if alias:
+            aliases[alias.lower()] = table.lower()
+    return aliases
+
+
+# Returns the full scans of checked tables in a plan, skipping those the entry point is expected to make.
+# A scan is also fine when the statement ends in ORDER BY and LIMIT, and rows come out of the scan already in that
+# order, since it stops as soon as enough rows are found.
+def full_scans(statement, plan, allowed_tables):
+    aliases = table_aliases(statement)
+    bounded = re.search(r'\bORDER BY [\w.]+( ASC| DESC)? LIMIT \d+\s*$', statement, re.IGNORECASE) and not any(
+        'USE TEMP B-TREE FOR ORDER BY' in detail for detail in plan)
+
+    scans = []
+    for detail in plan:
+        match = re.match(r'SCAN (\w+)', detail)
+        if match is None or 'VIRTUAL TABLE' in detail:
+            continue
+        table = aliases.get(match.group(1).lower(), match.group(1).lower())
+        if table in CHECKED_TABLES and table not in allowed_tables and not bounded:
+            scans.append(detail)
+    return scans
+
+
+# Writes a CSV with some stored movies unchanged, so upsert_movie_data runs its queries without cleaning any tags.
+def write_unchanged_csv(path, conn, movie_count):
+    rows = conn.execute("SELECT " + ', '.join(sqlite_functions.MOVIES_HEADERS) + " FROM movies "
+                        "ORDER BY id LIMIT ?", (movie_count,)).fetchall()
+    with open(path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(sqlite_functions.MOVIES_HEADERS)
+        writer.writerows(rows)
+
+
+# Every production entry point, with the tables it is expected to scan in full because it reads them whole.
+def entry_points(user_id, movie_id, csv_path):
+    return [
+        ("generate_tables", sqlite_functions.generate_tables, set()),
+        # The emptiness check stops at the first movie.
+        ("load_movie_data", sqlite_functions.load_movie_data, {'movies'}),
+        # Building the similarity index reads every movie on purpose.
+        ("load_similarity_index", movie_recommender_functions.load_similarity_index, {'movies'}),
+        ("select_movie", lambda: sqlite_functions.select_movie("young man", user_id), set()),
+        ("select_movie (all fields)", lambda: sqlite_functions.select_movie("young man", user_id, True), set()),
+        ("select_movie (typo)", lambda: sqlite_functions.select_movie("yuong mna", user_id), set()),
+        ("select_movie (common word)", lambda: sqlite_functions.select_movie(COMMON_WORD_TITLE, user_id), set()),
+        ("get_recommended_movies", lambda: movie_recommender_functions.get_recommended_movies(movie_id, user_id, 6),
+         set()),
+        ("recommend_based_on_watch_history",
+         lambda: movie_recommender_functions.recommend_based_on_watch_history(user_id), set()),
+        ("get_watch_history", lambda: sqlite_functions.get_watch_history(user_id), set()),
+        ("insert_or_update_watch_history",
+         lambda: sqlite_functions.insert_or_update_watch_history([user_id, movie_id, 1, 1, 0]), set()),
+        ("login_user", lambda: sqlite_functions.login_user("user0"), set()),
+        ("create_new_user", lambda: sqlite_functions.create_new_user("query plan check"), set()),
+        # A user without history falls back to the first movies by ID.
+        ("recommend_based_on_watch_history (new user)",
+         lambda: movie_recommender_functions.recommend_based_on_watch_history(user_id + 1000000), set()),
+        # Listing users returns every user on purpose.
+        ("get_users", sqlite_functions.get_users, {'users'}),
+        ("delete_user", lambda: sqlite_functions.delete_user("query plan check"), set()),
+        ("upsert_movie_data", lambda: sqlite_functions.upsert_movie_data(csv_path), set()),
+        # The batch job lists every user on purpose, then reads their history a range of IDs at a time.
+        ("recommend_all_users", lambda: batch_recommendations.recommend_all_users(processes=1), {'users'}),
+        ("get_user_recommendations", lambda: sqlite_functions.get_user_recommendations(user_id), set()),
+    ]
+
+
+# Builds a synthetic database, runs every entry point against it and checks the plan of every statement they run.
+# Returns the number of statements that fell back to a full table scan, plus one if the exact title search failed.
+def check_query_plans(movie_count, user_count, history_size, verbose=False):
+    with tempfile.TemporaryDirectory() as directory:
+        # A single pooled connection makes every entry point run on the connection being traced.
+        database.configure(os.path.join(directory, "query-plan-check.db"), pool_size=1)
+        sqlite_functions.generate_tables()
+        with database.connection() as conn:
+            user_ids = synthetic_data.populate_database(conn, movie_count, user_count, history_size)
+            movie_id = conn.execute("SELECT movie_id FROM watch_history WHERE user_id = ? AND liked = 1",
+                                    (user_ids[0],)).fetchone()[0]
+            csv_path = os.path.join(directory, "unchanged.csv")
+            write_unchanged_csv(csv_path, conn, 5)
+            common_word_id = conn.execute("INSERT INTO movies(title, year, genre, overview) "
+                                          "VALUES(?, 2000, 'Drama', '')", (COMMON_WORD_TITLE,)).lastrowid
+            conn.commit()
+
+        failures = 0
+        with database.connection() as conn:
+            for name, entry_point, allowed_tables in entry_points(user_ids[0], movie_id, csv_path):
+                recorder = PlanRecorder(conn)
+                conn.set_trace_callback(recorder)
+                try:
+                    entry_point()
+                finally:
+                    conn.set_trace_callback(None)
+
+                print(name)
+                for statement, plan in recorder.plans:
+                    scans = full_scans(statement, plan, allowed_tables)
+                    failures += len(scans)
+                    if scans or verbose:
+                        print("    " + ("FULL SCAN " if scans else "") + " ".join(statement.split())[:200])
+                        for detail in plan:
+                            print("        " + detail)
+
+        # Searches only read a bounded number of matches, which must never leave out a title matching exactly.
+        found = sqlite_functions.select_movie(COMMON_WORD_TITLE, user_ids[0])
+        if not found or found[0][0] != common_word_id:
+            print("select_movie did not return the movie titled " + repr(COMMON_WORD_TITLE) + " first: " +
+                  repr(found[:3]))
+            failures += 1
+
+        database.configure()
+        return failures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Fails if any production query scans a whole table, or if a search "
+                                                 "leaves out an exactly matching title.")
+    parser.add_argument("--movies", type=int, default=20000)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--history", type=int, default=200, help="watch history rows per user")
+    parser.add_argument("--verbose", action="store_true", help="print every statement and its plan")
+    args = parser.parse_args()
+
+    failure_count = check_query_plans(args.movies, args.users, args.history, args.verbose)
+    print(str(failure_count) + " problems found.")
+    sys.exit(1 if failure_count else 0)
@@ -0,0 +1,169 @@
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+import instrumentation
+import similarity_index
+
+# Upper bounds, in bytes, on the arrays held by each cache. The least recently used entries are evicted past them.
+NEIGHBOR_CACHE_BYTES = 64 * 1024 * 1024
+USER_CACHE_BYTES = 32 * 1024 * 1024
+
+# The results of a user are computed again after this many seconds, in case another process changed their watch
+# history, like the exclusion cache does.
+USER_CACHE_TTL_SECONDS = 600
+
+# Number of neighbors cached for a movie scored against the whole catalog. A user who excluded more of them than the
+# request can spare gets a deeper list, which then replaces the cached one.
+NEIGHBOR_CACHE_DEPTH = 100
+
+# Estimated bytes of an entry besides its arrays: the key, the dictionary slots and the array headers.
+ENTRY_OVERHEAD_BYTES = 512
+
+# Number of recently invalidated groups remembered to tell whether a result computed meanwhile is stale.
+REMEMBERED_INVALIDATIONS = 4096
+
+
+# A least recently used cache of numpy arrays computed from a similarity index, bounded by the bytes they take.
+# Keys are tuples whose first item is the group they belong to (a movie or a user), so a whole group can be invalidated
+# at once. Entries of an older index are never returned, and storing an entry for a new index drops the old ones.
+class ResultCache:
+    def __init__(self, max_bytes, ttl_seconds=None):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._index = None
+        self._entries = OrderedDict()
+        self._groups = {}
+        self._lock = threading.Lock()
+
+        # Results computed while their group was invalidated are stale and must not be stored. Every invalidation
+        # bumps the generation and is remembered per group, up to REMEMBERED_INVALIDATIONS groups; results computed
+        # before the last forgotten invalidation are then never stored.
+        self.generation = 0
+        self._invalidated = OrderedDict()
+        self._forgotten_generation = 0
+
+    # Returns the cached arrays of a key for the given index, or None. An entry that usable, if given, rejects counts as
+    # a miss.
+    def get(self, key, index, usable=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if (entry is not None and self._index is index and (usable is None or usable(entry[0]))
+                    and (self.ttl_seconds is None or time.monotonic() - entry[2] < self.ttl_seconds)):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            return None
+
+    # Stores a tuple of arrays computed from index, unless its group was invalidated since the given generation, read
+    # before computing them.
+    def put(self, key, index, arrays, generation):
+        nbytes = ENTRY_OVERHEAD_BYTES + sum(array.nbytes for array in arrays)
+        if nbytes > self.max_bytes:
+            return
+
+        with self._lock:
+            if generation < self._invalidated.get(key[0], self._forgotten_generation):
+                return
+            if self._index is not index:
+                self.invalidations += len(self._entries)
+                self._clear()
+                self._index = index
+
+            self._remove(key)
+            self._entries[key] = (arrays, nbytes, time.monotonic())
+            self._groups.setdefault(key[0], set()).add(key)
+            self.bytes += nbytes
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    # Drops every entry of a group, such as the results of a user whose watch history changed.
+    def invalidate(self, group):
+        with self._lock:
+            self.generation += 1
+            self._invalidated[group] = self.generation
+            self._invalidated.move_to_end(group)
+            while len(self._invalidated) > REMEMBERED_INVALIDATIONS:
+                self._forgotten_generation = self._invalidated.popitem(last=False)[1]
+
+            for key in list(self._groups.get(group, ())):
+                self._remove(key)
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._clear()
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "invalidations": self.invalidations, "entries": len(self._entries), "bytes": self.bytes,
+                    "max_bytes": self.max_bytes}
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self.bytes -= entry[1]
+        group = self._groups[key[0]]
+        group.discard(key)
+        if not group:
+            del self._groups[key[0]]
+
+    def _clear(self):
+        self._entries.clear()
+        self._groups.clear()
+        self.bytes = 0
+
+
+# The neighbors of movies scored against the whole catalog, shared by every user: movie ID -> (positions, scores).
+neighbor_cache = ResultCache(NEIGHBOR_CACHE_BYTES)
+
+# Results already filtered for a user: (user ID, kind, arguments...) -> arrays of index positions.
+user_cache = ResultCache(USER_CACHE_BYTES, USER_CACHE_TTL_SECONDS)
+
+
+# Returns the positions and scores of the movies closest to a movie, best first, leaving the movie itself out. The list
+# holds at least depth movies, or every movie when the catalog has fewer. Only a miss scores the catalog.
+def movie_neighbors(index, movie_id, depth=NEIGHBOR_CACHE_DEPTH):
+    # A list shorter than the depth it was computed for already holds the whole catalog.
+    cached = neighbor_cache.get((movie_id,), index, lambda arrays: len(arrays[0]) >= depth or arrays[2])
+    if cached is not None:
+        return cached[0], cached[1]
+
+    generation = neighbor_cache.generation
+    depth = max(depth, NEIGHBOR_CACHE_DEPTH)
+    with instrumentation.span("neighbors.score_catalog"):
+        scores = index.similarity_scores(movie_id)
+        scores[index.position_of(movie_id)] = -np.inf
+        positions = similarity_index.top_k_positions(scores, depth)
+    neighbor_cache.put((movie_id,), index, (positions, scores[positions], np.array(len(positions) < depth)),
+                       generation)
+    return positions, scores[positions]
+
+
+# Drops the cached results of a user, after their watch history changed or they were deleted.
+def forget_user(user_id):
+    user_cache.invalidate(user_id)
+
+
+def clear():
+    neighbor_cache.clear()
+    user_cache.clear()
+
+
+# Returns the counters of both caches.
+def stats():
+    return {"neighbors": neighbor_cache.stats(), "user_results": user_cache.stats()}
+
+
+instrumentation.register_collector("result_cache", stats)
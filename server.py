@@ -0,0 +1,151 @@
+import argparse
+import asyncio
+import json
+import sys
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import database
+import instrumentation
+import movie_recommender_functions
+import service
+import sqlite_functions
+
+HOST = "127.0.0.1"
+PORT = 8765
+
+# Threads running requests. SQLite and the sparse products release the GIL for most of their work, so as many threads
+# as pooled connections keep both busy while the event loop only parses and writes JSON.
+WORKERS = database.POOL_SIZE
+
+# Longest request line accepted, in bytes.
+MAX_REQUEST_BYTES = 1024 * 1024
+
+# Requests of one connection that may run at once. Clients sending more wait until a response goes out.
+MAX_PENDING_REQUESTS = 64
+
+# Seconds between two writes of the metrics file, when one is given.
+METRICS_INTERVAL_SECONDS = 15
+
+
+# Serves one client. Every line is a JSON request and gets one JSON line back. Requests are run concurrently, so
+# responses may come back out of order: a request's "id" field, if any, is copied into its response.
+async def handle_connection(reader, writer, executor):
+    loop = asyncio.get_running_loop()
+    pending = set()
+    slots = asyncio.Semaphore(MAX_PENDING_REQUESTS)
+    write_lock = asyncio.Lock()
+
+    async def respond(line):
+        try:
+            request = json.loads(line)
+        except ValueError:
+            request, response = None, {"error": "Invalid JSON."}
+        else:
+            try:
+                response = await loop.run_in_executor(executor, service.handle, request)
+            except Exception:
+                traceback.print_exc()
+                response = {"error": "Internal error."}
+
+        if isinstance(request, dict) and "id" in request:
+            response["id"] = request["id"]
+        try:
+            async with write_lock:
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            slots.release()
+
+    try:
+        while True:
+            try:
+                line = await reader.readline()
+            except ValueError:
+                # The line went over MAX_REQUEST_BYTES, so the rest of the stream cannot be trusted.
+                writer.write(json.dumps({"error": "Request too long."}).encode() + b"\n")
+                break
+            if not line:
+                break
+            if not line.strip():
+                continue
+
+            await slots.acquire()
+            task = asyncio.create_task(respond(line))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+    except ConnectionError:
+        pass
+    finally:
+        if pending:
+            await asyncio.gather(*pending)
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+
+
+# Writes the metrics file every METRICS_INTERVAL_SECONDS seconds, and once more when cancelled.
+async def write_metrics_periodically(path, executor):
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            await asyncio.sleep(METRICS_INTERVAL_SECONDS)
+            await loop.run_in_executor(executor, instrumentation.write_metrics, path)
+    finally:
+        instrumentation.write_metrics(path)
+
+
+# Prepares the database and the similarity index, then serves clients until cancelled.
+# ready, if given, is called with the address the server listens on, which tells the port chosen when port is 0.
+# With metrics_path, instrumentation is enabled and its metrics are written to that file (see write_metrics).
+async def serve(host=HOST, port=PORT, workers=WORKERS, ready=None, metrics_path=None):
+    if metrics_path:
+        instrumentation.enable()
+
+    sqlite_functions.generate_tables()
+    sqlite_functions.load_movie_data()
+    movie_recommender_functions.load_similarity_index()
+
+    with ThreadPoolExecutor(workers) as executor:
+        server = await asyncio.start_server(lambda reader, writer: handle_connection(reader, writer, executor),
+                                            host, port, limit=MAX_REQUEST_BYTES)
+        metrics_task = asyncio.create_task(write_metrics_periodically(metrics_path, executor)) if metrics_path else None
+        if ready is not None:
+            ready(server.sockets[0].getsockname()[:2])
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if metrics_task is not None:
+                metrics_task.cancel()
+
+
+def print_address(address):
+    print("Serving on " + address[0] + ":" + str(address[1]), flush=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serves the movie recommender as JSON lines over TCP.")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT, help="port to listen on, 0 to pick a free one")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="threads running requests")
+    parser.add_argument("--database", help="database file, by default the one database.py points at")
+    parser.add_argument("--metrics", metavar="FILE",
+                        help="enable instrumentation and write its metrics to FILE, as Prometheus text if it ends in "
+                             ".prom and as JSON otherwise")
+    parser.add_argument("--allow-profiling", action="store_true",
+                        help='let requests ask for their own profile with "profile": true')
+    args = parser.parse_args()
+
+    if args.database:
+        database.configure(args.database)
+    database.configure(pool_size=max(args.workers, database.POOL_SIZE))
+    service.ALLOW_PROFILING = args.allow_profiling
+    try:
+        asyncio.run(serve(args.host, args.port, args.workers, print_address, args.metrics))
+    except KeyboardInterrupt:
+        sys.exit(0)
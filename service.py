@@ -0,0 +1,145 @@
+import sqlite3
+
+import instrumentation
+import movie_recommender_functions
+import sqlite_functions
+
+# Largest number of movies a single request may ask for.
+MAX_QUANTITY = 100
+
+# Whether a request may ask for its own profile with "profile": true. Profiling slows the request down and shows code
+# paths to the client, so it is off unless the server is started with --allow-profiling.
+ALLOW_PROFILING = False
+
+
+# Raised for requests that are missing a field or have one of the wrong type. Its message is sent back to the client.
+class BadRequest(ValueError):
+    pass
+
+
+# Returns a required integer field of a request.
+def _int_field(request, name, default=None):
+    value = request.get(name, default)
+    if value is None:
+        raise BadRequest('Missing field "' + name + '".')
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise BadRequest('Field "' + name + '" must be an integer.')
+    return value
+
+
+def _flag_field(request, name):
+    value = request.get(name, False)
+    if not isinstance(value, (bool, int)) or value not in (0, 1):
+        raise BadRequest('Field "' + name + '" must be true or false.')
+    return int(value)
+
+
+def _quantity_field(request, default):
+    quantity = _int_field(request, "quantity", default)
+    if not 1 <= quantity <= MAX_QUANTITY:
+        raise BadRequest('Field "quantity" must be between 1 and ' + str(MAX_QUANTITY) + '.')
+    return quantity
+
+
+# Searches movie titles, or every text field with all_fields, leaving out the user's ignored movies.
+# Request: {"user_id", "query", "all_fields" (optional)}. Response: {"movies": [{"id", "title"}, ...]}.
+def search(request):
+    query = request.get("query")
+    if not isinstance(query, str):
+        raise BadRequest('Field "query" must be a string.')
+
+    results = sqlite_functions.select_movie(query, _int_field(request, "user_id"),
+                                            bool(request.get("all_fields", False)))
+    return {"movies": [{"id": movie_id, "title": title} for movie_id, title in results]}
+
+
+# Returns the movies most similar to one movie that the user has neither watched nor ignored.
+# Request: {"user_id", "movie_id", "quantity" (optional), "min_score" (optional)}.
+# Response: {"movies": [{"id", "title", "score"}, ...]}.
+def similar_movies(request):
+    min_score = request.get("min_score")
+    if min_score is not None and (isinstance(min_score, bool) or not isinstance(min_score, (int, float))):
+        raise BadRequest('Field "min_score" must be a number.')
+
+    try:
+        movie_ids, titles, scores = movie_recommender_functions.get_recommended_movies(
+            _int_field(request, "movie_id"), _int_field(request, "user_id"), _quantity_field(request, 6), min_score)
+    except KeyError:
+        raise BadRequest("Unknown movie " + str(request["movie_id"]) + ".")
+    return {"movies": [{"id": movie_id, "title": title, "score": score}
+                       for movie_id, title, score in zip(movie_ids, titles, scores)]}
+
+
+# Recommends movies based on everything the user liked.
+# Request: {"user_id", "quantity" (optional), "aggregation" (optional: "recency", "sum" or "max")}.
+# Response: {"recommendations": [{"id", "title", "reason"}, ...]}.
+def history_recommendations(request):
+    aggregation = request.get("aggregation", "recency")
+    if aggregation not in ("recency", "sum", "max"):
+        raise BadRequest('Field "aggregation" must be "recency", "sum" or "max".')
+
+    recommendations = movie_recommender_functions.recommend_based_on_watch_history(
+        _int_field(request, "user_id"), aggregation, _quantity_field(request, 6))
+    return {"recommendations": [{"id": movie_id, "title": title, "reason": reason.strip()}
+                                for title, reason, movie_id in recommendations]}
+
+
+# Returns the user's watch history, most recently edited first.
+# Request: {"user_id"}. Response: {"history": [{"id", "title", "watched", "liked", "ignored"}, ...]}.
+def watch_history(request):
+    rows = sqlite_functions.get_watch_history(_int_field(request, "user_id"))
+    return {"history": [{"id": row[0], "title": row[1], "watched": bool(row[2]), "liked": bool(row[3]),
+                         "ignored": bool(row[4])} for row in rows]}
+
+
+# Saves whether the user watched, liked or ignored a movie.
+# Request: {"user_id", "movie_id", "watched", "liked", "ignored"}, where missing flags are false.
+# Response: {"updated": true}.
+def update_history(request):
+    user_data = [_int_field(request, "user_id"), _int_field(request, "movie_id"), _flag_field(request, "watched"),
+                 _flag_field(request, "liked"), _flag_field(request, "ignored")]
+    try:
+        sqlite_functions.insert_or_update_watch_history(user_data)
+    except sqlite3.IntegrityError:
+        raise BadRequest("Unknown user or movie.")
+    return {"updated": True}
+
+
+ACTIONS = {
+    "search": search,
+    "similar_movies": similar_movies,
+    "history_recommendations": history_recommendations,
+    "watch_history": watch_history,
+    "update_history": update_history,
+}
+
+
+# Runs one request, picking the function from its "action" field. Errors are returned as {"error": message} instead
+# of being raised, so one bad request never takes down the server handling it.
+# With "profile": true, the response also gets a "profile" field with the request's spans, SQL statements, cProfile
+# output and peak memory, as captured by instrumentation.capture().
+def handle(request):
+    if not isinstance(request, dict):
+        return {"error": "A request must be a JSON object."}
+
+    action = ACTIONS.get(request.get("action")) if isinstance(request.get("action"), str) else None
+    if action is None:
+        return {"error": "Unknown action. Expected one of: " + ', '.join(ACTIONS) + "."}
+
+    if request.get("profile"):
+        if not ALLOW_PROFILING:
+            return {"error": "Profiling is disabled on this server."}
+        with instrumentation.capture() as report:
+            response = _run(action, request)
+        response["profile"] = report
+        return response
+    return _run(action, request)
+
+
+def _run(action, request):
+    try:
+        with instrumentation.span("request." + request["action"]):
+            return action(request)
+    except BadRequest as error:
+        instrumentation.count("request.bad_requests")
+        return {"error": str(error)}
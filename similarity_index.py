@@ -0,0 +1,463 @@
+import json
+import os
+import shutil
+import threading
+
+import numpy as np
+from scipy import sparse
+
+import database
+import feature_model
+import instrumentation
+
+# Number of precomputed neighbors stored for every movie. Setting this to 0 disables the neighbor table.
+NEIGHBOR_COUNT = 20
+
+# Term vectors and similarity scores are stored as float32, which halves their memory and is plenty for ranking.
+SCORE_DTYPE = np.float32
+
+# Upper bound, in bytes, on the scratch memory used to score a block of movies against the catalog while building the
+# neighbor table. The block size follows from it and the catalog size, so only a slice of the movie-by-movie scores
+# ever exists at once.
+NEIGHBOR_MEMORY_LIMIT = 256 * 1024 * 1024
+
+# Catalogs with at least this many movies get an approximate neighbor table from ann_index, which is much faster to
+# build than the exact one since that scores every pair of movies, but misses some of the true neighbors. 0, the
+# default, always builds the exact table.
+APPROXIMATE_NEIGHBORS_FROM = 0
+
+# Estimated scratch bytes per scored pair of movies: the sparse product (value and column index), its dense copy, the
+# negated copy and the int64 positions of the partial sort.
+BYTES_PER_SCORE = 24
+
+# Also save the index as a directory of .npy files next to its .npz file, which load_similarity_index maps into memory
+# instead of reading. Startup then only touches the pages requests need, and every process opening the same catalog,
+# such as batch workers, shares them through the page cache. A catalog directory that exists is kept up to date either
+# way, so this only decides whether a new one is created.
+MEMORY_MAPPED_CATALOG = False
+
+# The index currently loaded in memory, reused until the movies table changes.
+_loaded_index = None
+
+# Held while the index is loaded, rebuilt or updated, so concurrent requests never build it twice.
+_index_lock = threading.RLock()
+
+
+# Holds the L2-normalized feature vectors of every movie, so cosine similarity becomes a plain dot product.
+# The feature model that made them is kept along, so changed movies can be vectorized the same way.
+class SimilarityIndex:
+    def __init__(self, movie_ids, titles, features, matrix, version, neighbor_ids=None, neighbor_scores=None):
+        self.movie_ids = movie_ids
+        self.titles = titles
+        self.features = features
+        self.matrix = matrix
+        self.version = version
+        self.neighbor_ids = neighbor_ids
+        self.neighbor_scores = neighbor_scores
+        # Set when the neighbor table comes from ann_index, so lookups never take it for the exact neighbors.
+        self.approximate_neighbors = False
+
+    def __len__(self):
+        return len(self.movie_ids)
+
+    # Tells whether the index matches the given catalog version and the current field weights.
+    def is_current(self, version):
+        return self.version == version and self.features.weights_key() == feature_model.weights_key()
+
+    def __contains__(self, movie_id):
+        position = np.searchsorted(self.movie_ids, movie_id)
+        return position < len(self.movie_ids) and self.movie_ids[position] == movie_id
+
+    # Returns the row position of a movie. Movie IDs are stored in ascending order, so a binary search is enough.
+    def position_of(self, movie_id):
+        if movie_id not in self:
+            raise KeyError(movie_id)
+        return np.searchsorted(self.movie_ids, movie_id)
+
+    # Returns the positions of the given movie IDs, skipping any that are not in the index.
+    def positions_of(self, movie_ids):
+        movie_ids = np.asarray(movie_ids, dtype=self.movie_ids.dtype)
+        if len(self.movie_ids) == 0:
+            return np.array([], dtype=np.int64)
+
+        positions = np.searchsorted(self.movie_ids, movie_ids).clip(max=len(self.movie_ids) - 1)
+        return positions[self.movie_ids[positions] == movie_ids]
+
+    # Scores a single movie against the whole catalog with one sparse matrix-by-column product. Only the requested row
+    # is used, so memory grows with the catalog and its nonzeros rather than with the number of movie pairs.
+    def similarity_scores(self, movie_id):
+        row = self.matrix[self.position_of(movie_id)]
+        return (self.matrix @ row.T).toarray().ravel()
+
+    # Scores several seed movies against the whole catalog and aggregates them per candidate. Aggregation is either
+    # "sum" (weighted sum of similarities) or "max" (best weighted similarity of any seed). A sum is the catalog times
+    # the weighted sum of the seed vectors, so it takes one matrix-by-vector product however many seeds there are. A max
+    # needs the scores of every seed, so seeds are scored a block at a time, sized to stay under the memory limit.
+    def aggregate_similarity_scores(self, movie_ids, weights=None, aggregation="sum",
+                                    memory_limit=NEIGHBOR_MEMORY_LIMIT):
+        if aggregation not in ("sum", "max"):
+            raise ValueError("Unknown aggregation: " + str(aggregation))
+
+        positions = self.positions_of(movie_ids)
+        weights = np.ones(len(positions), dtype=SCORE_DTYPE) if weights is None else np.asarray(weights, SCORE_DTYPE)
+        if len(positions) == 0:
+            return np.zeros(len(self), dtype=SCORE_DTYPE)
+
+        if aggregation == "sum":
+            profile = sparse.csr_matrix(weights) @ self.matrix[positions]
+            instrumentation.record_value("aggregate.profile_nonzeros", profile.nnz)
+            return (self.matrix @ profile.T).toarray().ravel()
+
+        scores = np.full(len(self), -np.inf, dtype=SCORE_DTYPE)
+        block_size = neighbor_block_size(len(self), memory_limit)
+        for start in range(0, len(positions), block_size):
+            seeds = sparse.diags(weights[start:start + block_size]) @ self.matrix[positions[start:start + block_size]]
+            np.maximum(scores, (self.matrix @ seeds.T).toarray().max(axis=1), out=scores)
+        return scores
+
+    # Returns, for every candidate position, the index in movie_ids of the seed with the best weighted similarity to it,
+    # ties going to the first seed. Only the pairs of a seed and a candidate are scored, as row-wise dot products, so
+    # this is meant for the few candidates that were selected rather than the whole catalog.
+    def best_seeds(self, movie_ids, candidates, weights=None):
+        positions = self.positions_of(movie_ids)
+        weights = np.ones(len(positions), dtype=SCORE_DTYPE) if weights is None else np.asarray(weights, SCORE_DTYPE)
+        pair_candidates = np.repeat(np.asarray(candidates, dtype=np.int64), len(positions))
+        pair_seeds = np.tile(np.arange(len(positions)), len(candidates))
+        pair_scores = np.asarray(self.matrix[positions[pair_seeds]].multiply(
+            self.matrix[pair_candidates]).sum(axis=1)).ravel() * weights[pair_seeds]
+        return pair_scores.reshape(len(candidates), len(positions)).argmax(axis=1)
+
+
+# Returns the positions of the highest scores in descending order, using a partial selection instead of sorting every
+# score. Ties are broken by the lower position so results are stable, and -inf scores (excluded movies) are skipped,
+# as are scores below min_score when it is given.
+def top_k_positions(scores, quantity, min_score=None):
+    if min_score is None:
+        candidates = np.flatnonzero(scores > -np.inf)
+    else:
+        candidates = np.flatnonzero(scores >= min_score)
+
+    if quantity <= 0 or len(candidates) == 0:
+        return np.array([], dtype=np.int64)
+
+    candidate_scores = scores[candidates]
+    if len(candidates) > quantity:
+        # The k-th highest score splits the candidates: everything above it is kept, and the remaining slots go to
+        # the lowest positions tied with it. np.flatnonzero keeps positions in ascending order, so this stays stable.
+        kth_score = np.partition(candidate_scores, len(candidates) - quantity)[len(candidates) - quantity]
+        above = candidate_scores > kth_score
+        tied = np.flatnonzero(candidate_scores == kth_score)[:quantity - np.count_nonzero(above)]
+        selected = np.concatenate((np.flatnonzero(above), tied))
+        candidates, candidate_scores = candidates[selected], candidate_scores[selected]
+
+    # Only the selected scores are sorted, by descending score and then by ascending position.
+    order = np.lexsort((candidates, -candidate_scores))
+    return candidates[order]
+
+
+# Returns the version of the movies table. The counter is bumped by triggers whenever a movie changes, and the token
+# is random per database so an index built for a different database file is never mistaken for a current one.
+def get_catalog_version(conn):
+    row = conn.execute("SELECT catalog_token, version FROM catalog_version WHERE id = 1").fetchone()
+    return "" if row is None else row[0] + ":" + str(row[1])
+
+
+# This function vectorizes the tags, genres, director, stars, year and ratings of every movie into sparse,
+# L2-normalized feature vectors, weighted per field as set in feature_model.FIELD_WEIGHTS unless other weights are given.
+def build_similarity_index(conn, neighbor_count=NEIGHBOR_COUNT, memory_limit=NEIGHBOR_MEMORY_LIMIT,
+                           field_weights=None):
+    version = get_catalog_version(conn)
+    rows = conn.execute("SELECT id, title, " + ', '.join(feature_model.FEATURE_COLUMNS) + " "
+                        "FROM movies ORDER BY id").fetchall()
+
+    movie_ids = np.array([row[0] for row in rows], dtype=np.int64)
+    titles = np.array([row[1] or '' for row in rows], dtype=str)
+
+    with instrumentation.span("index.build.features"):
+        terms = feature_model.movie_terms(row[2:] for row in rows)
+        features = feature_model.fit_feature_model(terms, field_weights)
+        index = SimilarityIndex(movie_ids, titles, features, features.transform(terms, SCORE_DTYPE), version)
+    instrumentation.record_value("index.movies", len(index))
+    instrumentation.record_value("index.matrix_nonzeros", index.matrix.nnz)
+
+    with instrumentation.span("index.build.neighbors"):
+        if neighbor_count > 0 and APPROXIMATE_NEIGHBORS_FROM and len(index) >= APPROXIMATE_NEIGHBORS_FROM:
+            import ann_index  # Imported here since ann_index itself builds on this module.
+            index.neighbor_ids, index.neighbor_scores = ann_index.get_ann_index(index).neighbor_table(
+                index, neighbor_count, memory_limit=memory_limit)
+            index.approximate_neighbors = True
+        elif neighbor_count > 0:
+            index.neighbor_ids, index.neighbor_scores = build_neighbor_table(index, neighbor_count, memory_limit)
+    return index
+
+
+# Returns how many rows of candidate_count scores fit in the memory limit, with at least one row.
+def neighbor_block_size(candidate_count, memory_limit=NEIGHBOR_MEMORY_LIMIT):
+    return max(1, memory_limit // (max(candidate_count, 1) * BYTES_PER_SCORE))
+
+
+# This function precomputes the closest neighbors of every movie, scoring a block of rows at a time.
+# Rows with fewer neighbors than the table width are padded with an ID of -1 and a score of -inf.
+def build_neighbor_table(index, neighbor_count, memory_limit=NEIGHBOR_MEMORY_LIMIT):
+    return neighbors_for_positions(index, np.arange(len(index)), neighbor_count, memory_limit)
+
+
+# Returns the closest neighbors of the movies at the given positions, scoring as many rows at a time as fit in the
+# memory limit.
+def neighbors_for_positions(index, positions, neighbor_count, memory_limit=NEIGHBOR_MEMORY_LIMIT):
+    neighbor_count = min(neighbor_count, max(len(index) - 1, 0))
+    neighbor_ids = np.full((len(positions), neighbor_count), -1, dtype=np.int64)
+    neighbor_scores = np.full((len(positions), neighbor_count), -np.inf, dtype=SCORE_DTYPE)
+    if neighbor_count == 0:
+        return neighbor_ids, neighbor_scores
+
+    block_size = neighbor_block_size(len(index), memory_limit)
+    for start in range(0, len(positions), block_size):
+        block_positions = positions[start:start + block_size]
+        block = (index.matrix @ index.matrix[block_positions].T).T.toarray()
+
+        # A movie is never its own neighbor.
+        block[np.arange(len(block_positions)), block_positions] = -np.inf
+
+        end = start + len(block_positions)
+        neighbor_ids[start:end], neighbor_scores[start:end] = top_neighbors(block, index.movie_ids, neighbor_count)
+    return neighbor_ids, neighbor_scores
+
+
+# Picks the best neighbor_count candidates of every row, where candidate_ids holds the movie ID of every candidate
+# (either per row, or one row shared by all of them). Ties are broken by the lower movie ID.
+def top_neighbors(candidate_scores, candidate_ids, neighbor_count):
+    candidate_ids = np.broadcast_to(candidate_ids, candidate_scores.shape)
+    top = np.argpartition(-candidate_scores, neighbor_count - 1, axis=1)[:, :neighbor_count]
+    top_scores = np.take_along_axis(candidate_scores, top, axis=1)
+    top_ids = np.take_along_axis(candidate_ids, top, axis=1)
+
+    order = np.lexsort((top_ids, -top_scores))
+    top_ids = np.take_along_axis(top_ids, order, axis=1)
+    top_scores = np.take_along_axis(top_scores, order, axis=1)
+    top_ids[top_scores == -np.inf] = -1
+    return top_ids, top_scores
+
+
+# Updates the neighbor table of an incrementally updated index. Movies whose stored list does not involve a changed
+# movie only merge the changed movies' new scores into their list. The changed movies, and every movie that listed one
+# of them as a neighbor, get their neighbors computed again since part of their list is stale.
+def _update_neighbor_table(index, previous_index, changed_ids, neighbor_count, memory_limit=NEIGHBOR_MEMORY_LIMIT):
+    neighbor_count = min(neighbor_count, max(len(index) - 1, 0))
+    neighbor_ids = np.full((len(index), neighbor_count), -1, dtype=np.int64)
+    neighbor_scores = np.full((len(index), neighbor_count), -np.inf, dtype=SCORE_DTYPE)
+    if neighbor_count == 0:
+        return neighbor_ids, neighbor_scores
+
+    # Lists are only carried over when they are complete and do not mention a changed movie.
+    kept = ~np.isin(previous_index.movie_ids, changed_ids)
+    if previous_index.neighbor_ids.shape[1] == neighbor_count:
+        kept &= ~np.isin(previous_index.neighbor_ids, changed_ids).any(axis=1)
+    else:
+        kept[:] = False
+    kept_positions = index.positions_of(previous_index.movie_ids[kept])
+    neighbor_ids[kept_positions] = previous_index.neighbor_ids[kept]
+    neighbor_scores[kept_positions] = previous_index.neighbor_scores[kept]
+
+    # Here a block holds the scores of every kept movie against some of the changed ones, so it is sized by columns.
+    changed_positions = index.positions_of(changed_ids)
+    block_size = neighbor_block_size(len(kept_positions), memory_limit)
+    for start in range(0, len(changed_positions), block_size):
+        block_positions = changed_positions[start:start + block_size]
+        block_scores = (index.matrix @ index.matrix[block_positions].T)[kept_positions].toarray()
+
+        candidate_ids = np.concatenate((neighbor_ids[kept_positions], np.broadcast_to(
+            index.movie_ids[block_positions], block_scores.shape)), axis=1)
+        candidate_scores = np.concatenate((neighbor_scores[kept_positions], block_scores), axis=1)
+        neighbor_ids[kept_positions], neighbor_scores[kept_positions] = top_neighbors(candidate_scores, candidate_ids,
+                                                                                     neighbor_count)
+
+    recomputed_positions = np.setdiff1d(np.arange(len(index)), kept_positions)
+    neighbor_ids[recomputed_positions], neighbor_scores[recomputed_positions] = neighbors_for_positions(
+        index, recomputed_positions, neighbor_count, memory_limit)
+    return neighbor_ids, neighbor_scores
+
+
+# The index is stored next to the database file unless another path is given.
+def save_similarity_index(index, path=None):
+    path = path or database.index_path()
+    arrays = {
+        "movie_ids": index.movie_ids,
+        "titles": index.titles,
+        "vocabulary": np.array(index.features.vocabulary, dtype=str),
+        "idf": index.features.idf,
+        "field_weights": np.array(index.features.weights_key()),
+        "data": index.matrix.data,
+        "indices": index.matrix.indices,
+        "indptr": index.matrix.indptr,
+        "shape": np.array(index.matrix.shape),
+        "version": np.array(index.version),
+    }
+    if index.neighbor_ids is not None:
+        arrays["neighbor_ids"] = index.neighbor_ids
+        arrays["neighbor_scores"] = index.neighbor_scores
+        arrays["approximate_neighbors"] = np.array(index.approximate_neighbors)
+
+    # Writes to a temporary file first so a crash never leaves a half-written index behind.
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "wb") as file:
+        np.savez(file, **arrays)
+    os.replace(temporary_path, path)
+
+    if MEMORY_MAPPED_CATALOG or os.path.isdir(catalog_path(path)):
+        save_catalog(arrays, catalog_path(path))
+
+
+# Returns the path of the memory-mapped catalog directory kept next to an index file.
+def catalog_path(path=None):
+    return os.path.splitext(path or database.index_path())[0]
+
+
+# Writes the arrays of an index as one .npy file each, so they can be mapped into memory one by one.
+# The directory is written in full under a temporary name and swapped in, so a reader never sees half of it. Processes
+# still mapping the previous catalog keep reading its files until they let go of them.
+def save_catalog(arrays, directory):
+    temporary_directory = directory + ".tmp"
+    shutil.rmtree(temporary_directory, ignore_errors=True)
+    os.makedirs(temporary_directory)
+    for name, array in arrays.items():
+        np.save(os.path.join(temporary_directory, name + ".npy"), array)
+
+    previous_directory = directory + ".old"
+    shutil.rmtree(previous_directory, ignore_errors=True)
+    if os.path.isdir(directory):
+        os.rename(directory, previous_directory)
+    os.rename(temporary_directory, directory)
+    shutil.rmtree(previous_directory, ignore_errors=True)
+
+
+# Returns the index stored on disk, or None if there is no usable index file.
+# A memory-mapped catalog is preferred over the .npz file when there is one.
+def load_similarity_index(path=None):
+    path = path or database.index_path()
+    if os.path.isdir(catalog_path(path)):
+        return load_catalog(catalog_path(path))
+    if not os.path.exists(path):
+        return None
+
+    # Indexes saved before scores were stored as float32 are converted when they are loaded.
+    with np.load(path) as arrays:
+        # Indexes saved before the feature model only hold tag terms, and are rebuilt.
+        if "idf" not in arrays:
+            return None
+        return _index_from_arrays(arrays)
+
+
+# Maps the arrays of a catalog directory into memory, read-only. Nothing is copied, so the index is ready as soon as
+# the files are opened and its pages are only read from disk once they are used.
+def load_catalog(directory):
+    arrays = {}
+    for name in os.listdir(directory):
+        if name.endswith(".npy"):
+            arrays[name[:-len(".npy")]] = np.load(os.path.join(directory, name), mmap_mode='r')
+    if "idf" not in arrays:
+        return None
+    return _index_from_arrays(arrays)
+
+
+def _index_from_arrays(arrays):
+    features = feature_model.FeatureModel(arrays["vocabulary"], arrays["idf"],
+                                          json.loads(arrays["field_weights"].item()))
+    matrix = sparse.csr_matrix((arrays["data"].astype(SCORE_DTYPE, copy=False), arrays["indices"],
+                                arrays["indptr"]), shape=tuple(arrays["shape"]))
+    neighbor_ids = arrays["neighbor_ids"] if "neighbor_ids" in arrays else None
+    neighbor_scores = arrays["neighbor_scores"].astype(SCORE_DTYPE, copy=False) \
+        if "neighbor_scores" in arrays else None
+    index = SimilarityIndex(arrays["movie_ids"], arrays["titles"], features, matrix, arrays["version"].item(),
+                            neighbor_ids, neighbor_scores)
+    index.approximate_neighbors = "approximate_neighbors" in arrays and bool(arrays["approximate_neighbors"])
+    return index
+
+
+# Returns an index matching the current movies table.
+# The in-memory index is reused first, then the one on disk, and the index is only rebuilt if both are out of date.
+def get_similarity_index(conn, path=None):
+    global _loaded_index
+    path = path or database.index_path()
+    version = get_catalog_version(conn)
+
+    if _loaded_index is not None and _loaded_index.is_current(version):
+        return _loaded_index
+
+    with _index_lock:
+        if _loaded_index is not None and _loaded_index.is_current(version):
+            return _loaded_index
+
+        with instrumentation.span("index.load"):
+            index = load_similarity_index(path)
+        if index is None or not index.is_current(version):
+            with instrumentation.span("index.build"):
+                index = build_similarity_index(conn)
+                save_similarity_index(index, path)
+
+        _loaded_index = index
+        return index
+
+
+# Forgets the index held in memory, so the next call to get_similarity_index reads it from disk again.
+def unload_similarity_index():
+    global _loaded_index
+    with _index_lock:
+        _loaded_index = None
+
+
+# Updates the index for just the given movies after they were inserted or changed, instead of rebuilding it.
+# Features are normalized per movie, so the vectors of untouched movies stay valid and new terms only add columns.
+# If the stored index does not match the catalog as it was before the change, the index is rebuilt instead.
+def update_similarity_index(conn, movie_ids, previous_version, path=None):
+    with _index_lock:
+        return _update_similarity_index(conn, movie_ids, previous_version, path)
+
+
+def _update_similarity_index(conn, movie_ids, previous_version, path):
+    global _loaded_index
+    if _loaded_index is not None and _loaded_index.is_current(previous_version):
+        previous_index = _loaded_index
+    else:
+        previous_index = load_similarity_index(path)
+
+    if (previous_index is None or not previous_index.is_current(previous_version)
+            or previous_index.neighbor_ids is None):
+        return get_similarity_index(conn, path)
+
+    changed_ids = np.unique(np.asarray(movie_ids, dtype=np.int64))
+    if len(changed_ids) == 0:
+        return get_similarity_index(conn, path)
+
+    rows = conn.execute("SELECT id, title, " + ', '.join(feature_model.FEATURE_COLUMNS) + " FROM movies "
+                        "WHERE id IN (SELECT value FROM json_each(?)) "
+                        "ORDER BY id", (json.dumps(changed_ids.tolist()),)).fetchall()
+    terms = feature_model.movie_terms(row[2:] for row in rows)
+
+    # New terms are appended to the end of the vocabulary, so existing columns keep their meaning. The IDF weights of
+    # known terms are kept from the last full build, so untouched vectors stay valid.
+    previous_features = previous_index.features
+    features = feature_model.FeatureModel(previous_features.vocabulary, previous_features.idf,
+                                          previous_features.field_weights)
+    new_movie_count = np.count_nonzero(~np.isin(changed_ids, previous_index.movie_ids))
+    features.add_terms(terms, len(previous_index) + new_movie_count)
+
+    changed_rows = features.transform(terms, SCORE_DTYPE)
+    previous_rows = previous_index.matrix.copy()
+    previous_rows.resize((previous_rows.shape[0], len(features.vocabulary)))
+
+    # Untouched rows are kept as they are and the changed rows are put back in ascending ID order.
+    kept = ~np.isin(previous_index.movie_ids, changed_ids)
+    movie_ids = np.concatenate((previous_index.movie_ids[kept], np.array([row[0] for row in rows], dtype=np.int64)))
+    titles = np.concatenate((previous_index.titles[kept], np.array([row[1] or '' for row in rows], dtype=str)))
+    order = np.argsort(movie_ids, kind='stable')
+    matrix = sparse.vstack((previous_rows[kept], changed_rows)).tocsr()[order]
+
+    index = SimilarityIndex(movie_ids[order], titles[order], features, matrix, get_catalog_version(conn))
+    index.neighbor_ids, index.neighbor_scores = _update_neighbor_table(index, previous_index, changed_ids,
+                                                                       NEIGHBOR_COUNT)
+    # Lists carried over from an approximate table stay approximate.
+    index.approximate_neighbors = previous_index.approximate_neighbors
+    save_similarity_index(index, path)
+    _loaded_index = index
+    return index
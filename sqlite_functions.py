@@ -1,156 +1,533 @@
-import sqlite3
+import csv
+import math
 import re
-import nltk
+import sqlite3
+
+import database
+import exclusion_cache
+import instrumentation
+import result_cache
+import similarity_index
+import text_cleaning
+
 
-import pandas as pd
-from nltk import word_tokenize, WordNetLemmatizer
-from nltk.corpus import stopwords
+# Oldest SQLite library these tables and queries work with: upserts use UPDATE ... FROM and RETURNING (3.35), and
+# the contains search uses the FTS5 trigram tokenizer (3.34).
+MIN_SQLITE_VERSION = (3, 35, 0)
 
-conn = sqlite3.connect("movie-records.db")
-cur = conn.cursor()
-cur.execute("PRAGMA foreign_keys = 1")  # Necessary for the cascading delete of users and watch history.
 
-nltk.download('punkt')
-nltk.download('wordnet')
-nltk.download('stopwords')
+# Makes sure the SQLite library Python is linked against is recent enough, before any table is created with it.
+def check_sqlite_version():
+    if sqlite3.sqlite_version_info < MIN_SQLITE_VERSION:
+        raise RuntimeError("SQLite " + '.'.join(map(str, MIN_SQLITE_VERSION)) + " or newer is required, but Python "
+                           "is using SQLite " + sqlite3.sqlite_version + ". Install a Python built against a newer "
+                           "SQLite library.")
 
 
 def generate_tables():
-    # Table for user data
+    check_sqlite_version()
+    with database.transaction() as conn:
+        cur = conn.cursor()
+
+        # Table for user data
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS users(id integer PRIMARY KEY,
+                                    username varchar(50) NOT NULL UNIQUE,
+                                    last_login datetime DEFAULT NULL);
+            """)
+
+        # Table for movie data
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS movies(id integer PRIMARY KEY,
+                                    poster_link text,
+                                    title varchar(100),
+                                    year integer,
+                                    certificate varchar(20),
+                                    runtime varchar(20),
+                                    genre varchar(100),
+                                    imdb_rating decimal(4,2),
+                                    overview text,
+                                    meta_score integer,
+                                    director varchar(100),
+                                    star1 varchar(100),
+                                    star2 varchar(100),
+                                    star3 varchar(100),
+                                    star4 varchar(100),
+                                    similarity_tags text);
+            """)
+
+        # Table for users' watch history
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS watch_history(user_id integer,
+                                    movie_id integer,
+                                    watched integer CHECK (watched IN (0, 1)),
+                                    liked integer CHECK (liked IN (0, 1)),
+                                    ignored integer CHECK (ignored IN (0, 1)),
+                                    creation_date datetime DEFAULT current_timestamp,
+                                    last_edited datetime default NULL,
+                                    FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE,
+                                    FOREIGN KEY(movie_id) REFERENCES movies(id) ON DELETE CASCADE,
+                                    PRIMARY KEY(user_id, movie_id));
+            """)
+
+        # Movies are identified by title and year when loading updates from CSV files.
+        cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS movies_title_year ON movies(title, year)")
+        # Searches read the titles starting with the searched text in alphabetical order from this index.
+        cur.execute("CREATE INDEX IF NOT EXISTS movies_title_lower ON movies(lower(title))")
+
+        # Indexes for the watch history queries, which always filter on a single user. The partial index holds just
+        # the movies excluded from recommendations, the liked index serves recommendations based on watch history,
+        # and the last_edited index returns watch history already in order. The movie_id index keeps the cascading
+        # delete of a movie from scanning the whole table.
+        cur.execute("CREATE INDEX IF NOT EXISTS watch_history_user_excluded ON watch_history(user_id, movie_id) "
+                    "WHERE watched = 1 OR ignored = 1")
+        cur.execute("CREATE INDEX IF NOT EXISTS watch_history_user_liked "
+                    "ON watch_history(user_id, liked, ignored, last_edited)")
+        cur.execute("CREATE INDEX IF NOT EXISTS watch_history_user_edited ON watch_history(user_id, last_edited)")
+        cur.execute("CREATE INDEX IF NOT EXISTS watch_history_movie ON watch_history(movie_id)")
+
+        # Table for the recommendations precomputed for every user by batch_recommendations.py, best first.
+        # reason_movie_id is the liked movie that contributed most, and is NULL for filler movies.
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS user_recommendations(user_id integer,
+                                    rank integer,
+                                    movie_id integer,
+                                    score real,
+                                    reason_movie_id integer,
+                                    created_at datetime NOT NULL,
+                                    FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE,
+                                    FOREIGN KEY(movie_id) REFERENCES movies(id) ON DELETE CASCADE,
+                                    PRIMARY KEY(user_id, rank));
+            """)
+        cur.execute("CREATE INDEX IF NOT EXISTS user_recommendations_movie ON user_recommendations(movie_id)")
+
+        # Single-row table tracking changes to the movies table, so the similarity index knows when to rebuild.
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS catalog_version(id integer PRIMARY KEY CHECK (id = 1),
+                                    catalog_token text NOT NULL,
+                                    version integer NOT NULL);
+            """)
+        cur.execute("INSERT OR IGNORE INTO catalog_version(id, catalog_token, version) "
+                    "VALUES(1, lower(hex(randomblob(8))), 0)")
+
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            cur.execute(
+                """
+                CREATE TRIGGER IF NOT EXISTS movies_{0}_version AFTER {1} ON movies
+                BEGIN
+                    UPDATE catalog_version SET version = version + 1 WHERE id = 1;
+                END;
+                """.format(event.lower(), event))
+
+        generate_search_tables(cur)
+
+
+# Full-text search tables over the movies table. movies_fts holds words for prefix search ranked by bm25, and
+# movies_title_trigram holds every three-letter sequence of the titles for substring and typo-tolerant search.
+# Both are external content tables, so they store no copy of the text and are kept in sync by triggers.
+def generate_search_tables(cur):
+    existing_tables = {row[0] for row in cur.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    search_columns = ', '.join(SEARCH_COLUMNS)
+    new_values = ', '.join('new.' + column for column in SEARCH_COLUMNS)
+    old_values = ', '.join('old.' + column for column in SEARCH_COLUMNS)
+
+    cur.execute("CREATE VIRTUAL TABLE IF NOT EXISTS movies_fts "
+                "USING fts5(" + search_columns + ", content='movies', content_rowid='id', "
+                "tokenize='unicode61 remove_diacritics 2', prefix='2 3')")
+    cur.execute("CREATE VIRTUAL TABLE IF NOT EXISTS movies_title_trigram "
+                "USING fts5(title, content='movies', content_rowid='id', tokenize='trigram')")
+
+    create_search_insert_trigger(cur)
     cur.execute(
         """
-        CREATE TABLE IF NOT EXISTS users(id integer PRIMARY KEY,
-                                username varchar(50) NOT NULL UNIQUE,
-                                last_login datetime DEFAULT NULL);
-        """)
-
-    # Table for movie data
+        CREATE TRIGGER IF NOT EXISTS movies_delete_search AFTER DELETE ON movies
+        BEGIN
+            INSERT INTO movies_fts(movies_fts, rowid, {0}) VALUES('delete', old.id, {1});
+            INSERT INTO movies_title_trigram(movies_title_trigram, rowid, title) VALUES('delete', old.id, old.title);
+        END;
+        """.format(search_columns, old_values))
     cur.execute(
         """
-        CREATE TABLE IF NOT EXISTS movies(id integer PRIMARY KEY,
-                                poster_link text,
-                                title varchar(100),
-                                year integer,
-                                certificate varchar(20),
-                                runtime varchar(20),
-                                genre varchar(100),
-                                imdb_rating decimal(4,2),
-                                overview text,
-                                meta_score integer,
-                                director varchar(100),
-                                star1 varchar(100),
-                                star2 varchar(100),
-                                star3 varchar(100),
-                                star4 varchar(100),
-                                similarity_tags text);
-        """)
-
-    # Table for users' watch history
+        CREATE TRIGGER IF NOT EXISTS movies_update_search AFTER UPDATE ON movies
+        BEGIN
+            INSERT INTO movies_fts(movies_fts, rowid, {0}) VALUES('delete', old.id, {1});
+            INSERT INTO movies_title_trigram(movies_title_trigram, rowid, title) VALUES('delete', old.id, old.title);
+            INSERT INTO movies_fts(rowid, {0}) VALUES(new.id, {2});
+            INSERT INTO movies_title_trigram(rowid, title) VALUES(new.id, new.title);
+        END;
+        """.format(search_columns, old_values, new_values))
+
+    # Databases created before the search tables existed already hold movies, which are indexed once here.
+    if 'movies_fts' not in existing_tables:
+        cur.execute("INSERT INTO movies_fts(movies_fts) VALUES('rebuild')")
+    if 'movies_title_trigram' not in existing_tables:
+        cur.execute("INSERT INTO movies_title_trigram(movies_title_trigram) VALUES('rebuild')")
+
+
+# The trigger indexing inserted movies for search, which load_movie_data drops for the length of a bulk load.
+def create_search_insert_trigger(cur):
     cur.execute(
         """
-        CREATE TABLE IF NOT EXISTS watch_history(user_id integer,
-                                movie_id integer,
-                                watched integer CHECK (watched IN (0, 1)),
-                                liked integer CHECK (liked IN (0, 1)),
-                                ignored integer CHECK (ignored IN (0, 1)),
-                                creation_date datetime DEFAULT current_timestamp,
-                                last_edited datetime default NULL,
-                                FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE,
-                                FOREIGN KEY(movie_id) REFERENCES movies(id) ON DELETE CASCADE,
-                                PRIMARY KEY(user_id, movie_id));
-        """)
+        CREATE TRIGGER IF NOT EXISTS movies_insert_search AFTER INSERT ON movies
+        BEGIN
+            INSERT INTO movies_fts(rowid, {0}) VALUES(new.id, {1});
+            INSERT INTO movies_title_trigram(rowid, title) VALUES(new.id, new.title);
+        END;
+        """.format(', '.join(SEARCH_COLUMNS), ', '.join('new.' + column for column in SEARCH_COLUMNS)))
 
 
 # This function converts text to lowercase, removes punctuation and stopwords, and then lemmatizes everything else.
 def clean_text_for_tags(text):
-    text = text.lower()
+    return text_cleaning.get_tag_cleaner().clean(text)
+
+
+# Columns of the movies table covered by full-text search, and their bm25 weights (in the same order).
+SEARCH_COLUMNS = ['title', 'director', 'star1', 'star2', 'star3', 'star4', 'overview']
+SEARCH_WEIGHTS = "10.0, 2.0, 1.0, 1.0, 1.0, 1.0, 0.5"
+
+# Number of matches a search looks at. bm25 scores every match, so words matching more movies than this have their
+# first matches by ID ranked by title length instead, and the typo search only looks at this many titles sharing a
+# three-letter sequence with the searched text.
+SEARCH_CANDIDATES = 200
 
-    # Removes punctuation from the text using a regular expression
-    text = re.sub(r'[^\w\s\d]', '', text)
+# Fraction of the searched text's three-letter sequences, and at least two of them, that a title must share to be
+# suggested by the typo search.
+TYPO_MIN_SHARED = 1 / 3
 
-    # Tokenizes the text into words and then removes the stopwords
-    words = word_tokenize(text)
-    words = [word for word in words if word not in set(stopwords.words('english'))]
+MOVIES_HEADERS = ['poster_link', 'title', 'year', 'certificate', 'runtime', 'genre', 'imdb_rating', 'overview',
+                  'meta_score', 'director', 'star1', 'star2', 'star3', 'star4']
 
-    # Lemmatize each word
-    words = [WordNetLemmatizer().lemmatize(word) for word in words]
+# Number of CSV rows read, cleaned and inserted at a time by load_movie_data, which bounds the memory a load takes
+# whatever the size of the file.
+LOAD_CHUNK_ROWS = 10000
 
-    # Rebuilds a string from the cleaned and lemmatized words
-    text = ' '.join(words)
-    return text
+
+# Reads a movies CSV laid out like imdb_top_1000.csv, skipping its header row.
+def read_movies_csv(movies_data_csv):
+    import pandas as pd  # pandas is only imported once a CSV actually needs to be read, which keeps startup fast.
+    return pd.read_csv(movies_data_csv, names=MOVIES_HEADERS, skiprows=1)
+
+
+# Reads a movies CSV laid out like imdb_top_1000.csv in lists of at most chunk_rows rows, skipping its header row.
+# Rows are lists of the MOVIES_HEADERS columns, where empty fields are None like the missing values pandas reads.
+def read_movies_csv_chunks(movies_data_csv, chunk_rows=LOAD_CHUNK_ROWS):
+    with open(movies_data_csv, newline='', encoding='utf-8') as file:
+        reader = csv.reader(file)
+        next(reader, None)
+
+        chunk = []
+        for row in reader:
+            row = [value if value != '' else None for value in row[:len(MOVIES_HEADERS)]]
+            chunk.append(row + [None] * (len(MOVIES_HEADERS) - len(row)))
+            if len(chunk) == chunk_rows:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
 
 
 # If the database is empty, this method will populate it from the chosen CSV file.
-def load_movie_data():
-    # Retrieves row 1 of the movies table. If there are no rows, it will return zero, meaning the table is empty.
-    row_count = cur.execute("SELECT EXISTS (SELECT 1 FROM movies);").fetchone()[0]
+# The CSV is streamed a chunk of rows at a time: each chunk has its tags cleaned, by a pool of worker processes if
+# asked to, and is inserted with executemany, all in one bulk load transaction. Indexing every row for search as it is
+# inserted costs several times more than the insert itself, so the search tables are rebuilt once at the end instead,
+# in the same transaction.
+def load_movie_data(processes=None, movies_data_csv='imdb_top_1000.csv'):
+    with database.connection() as conn:
+        # Retrieves row 1 of the movies table. If there are no rows, it will return zero, meaning the table is empty.
+        if conn.execute("SELECT EXISTS (SELECT 1 FROM movies);").fetchone()[0]:
+            return
+
+    genre, overview = MOVIES_HEADERS.index('genre'), MOVIES_HEADERS.index('overview')
+    columns = MOVIES_HEADERS + ['similarity_tags']
+    with database.bulk_load() as conn:
+        cur = conn.cursor()
+        cur.execute("DROP TRIGGER movies_insert_search")
+        cleaned_chunks = text_cleaning.get_tag_cleaner().clean_chunks(
+            read_movies_csv_chunks(movies_data_csv), lambda row: (row[genre] or '') + ' ' + (row[overview] or ''),
+            processes)
+        while True:
+            with instrumentation.span("load.clean_tags"):
+                chunk, tags = next(cleaned_chunks, (None, None))
+            if chunk is None:
+                break
+            with instrumentation.span("load.insert"):
+                cur.executemany("INSERT INTO movies(" + ', '.join(columns) + ") "
+                                "VALUES(" + ', '.join('?' * len(columns)) + ")",
+                                [row + [row_tags] for row, row_tags in zip(chunk, tags)])
+
+        with instrumentation.span("load.search_index"):
+            cur.execute("INSERT INTO movies_fts(movies_fts) VALUES('rebuild')")
+            cur.execute("INSERT INTO movies_title_trigram(movies_title_trigram) VALUES('rebuild')")
+        create_search_insert_trigger(cur)
+
 
-    # If the movies table is empty, the following will populate it from a CSV and prepare a tags column for later.
-    if row_count == 0:
-        movies_data_csv = 'imdb_top_1000.csv'
-        movies_headers = ['poster_link', 'title', 'year', 'certificate', 'runtime', 'genre', 'imdb_rating', 'overview',
-                          'meta_score', 'director', 'star1', 'star2', 'star3', 'star4']
-        movies_df = pd.read_csv(movies_data_csv, names=movies_headers, skiprows=1)
-        movies_df['similarity_tags'] = movies_df['genre'] + ' ' + movies_df['overview']
-        movies_df['similarity_tags'] = movies_df['similarity_tags'].apply(clean_text_for_tags)
+# This function adds new movies and updates changed ones from one or more CSV files, matching movies on title and year.
+# Tags are only cleaned for rows whose genre or overview changed, and the similarity index is updated for just the
+# affected movies. Returns the IDs of the movies that were inserted or updated.
+def upsert_movie_data(movies_data_csvs, processes=None):
+    if isinstance(movies_data_csvs, str):
+        movies_data_csvs = [movies_data_csvs]
 
-        movies_df.to_sql('movies', conn, if_exists='append', index=False)
+    import pandas as pd
+
+    # Later files win when the same movie appears more than once.
+    movies_df = pd.concat([read_movies_csv(path) for path in movies_data_csvs], ignore_index=True)
+    movies_df = movies_df.drop_duplicates(subset=['title', 'year'], keep='last')
+    movies_df = movies_df.astype(object).where(movies_df.notna(), None)
+
+    with database.transaction() as conn:
+        cur = conn.cursor()
+        previous_version = similarity_index.get_catalog_version(conn)
+        columns = ', '.join(MOVIES_HEADERS)
+
+        # The CSV rows are staged in a temporary table with the same column affinities as movies, so comparing them
+        # with the stored rows happens in SQL with the same type conversions as a real insert.
+        cur.execute("DROP TABLE IF EXISTS temp.movies_staging")
+        cur.execute("CREATE TEMP TABLE movies_staging AS SELECT id AS movie_id, " + columns + ", similarity_tags "
+                    "FROM movies WHERE 0")
+        placeholders = ', '.join('?' * len(MOVIES_HEADERS))
+        cur.executemany("INSERT INTO movies_staging(" + columns + ") VALUES(" + placeholders + ")",
+                        movies_df[MOVIES_HEADERS].itertuples(index=False, name=None))
+
+        # Every row is matched with its stored movie first. IS is used instead of = so movies without a year match too,
+        # which the unique index on title and year cannot do since it treats every NULL year as different.
+        cur.execute("UPDATE movies_staging "
+                    "SET movie_id = (SELECT m.id FROM movies m "
+                    "WHERE m.title IS movies_staging.title AND m.year IS movies_staging.year ORDER BY m.id LIMIT 1)")
+
+        # Unchanged tags are copied over from the stored movie, so only new or edited descriptions are cleaned again.
+        cur.execute("UPDATE movies_staging "
+                    "SET similarity_tags = (SELECT m.similarity_tags FROM movies m "
+                    "WHERE m.id = movies_staging.movie_id "
+                    "AND m.genre IS movies_staging.genre AND m.overview IS movies_staging.overview)")
+        rows_to_tag = cur.execute("SELECT rowid, genre, overview FROM movies_staging "
+                                  "WHERE similarity_tags IS NULL").fetchall()
+        if rows_to_tag:
+            with instrumentation.span("load.clean_tags"):
+                tags = text_cleaning.get_tag_cleaner().clean_many(
+                    [(row[1] or '') + ' ' + (row[2] or '') for row in rows_to_tag], processes)
+            cur.executemany("UPDATE movies_staging SET similarity_tags = ? WHERE rowid = ?",
+                            zip(tags, [row[0] for row in rows_to_tag]))
+
+        # Rows identical to the stored movie are left alone, so they do not bump the catalog version.
+        unchanged = " AND ".join("m." + column + " IS s." + column
+                                 for column in MOVIES_HEADERS + ['similarity_tags'])
+        cur.execute("DELETE FROM movies_staging AS s "
+                    "WHERE EXISTS (SELECT 1 FROM movies m WHERE m.id = s.movie_id AND " + unchanged + ")")
+
+        # The IDs come back from the writes themselves, so every changed or added movie is reported.
+        updates = ', '.join(column + ' = s.' + column for column in MOVIES_HEADERS + ['similarity_tags'])
+        movie_ids = [row[0] for row in cur.execute("UPDATE movies SET " + updates + " "
+                                                   "FROM movies_staging s WHERE movies.id = s.movie_id "
+                                                   "RETURNING id").fetchall()]
+        movie_ids += [row[0] for row in cur.execute("INSERT INTO movies(" + columns + ", similarity_tags) "
+                                                    "SELECT " + columns + ", similarity_tags FROM movies_staging "
+                                                    "WHERE movie_id IS NULL ORDER BY rowid "
+                                                    "RETURNING id").fetchall()]
+        cur.execute("DROP TABLE temp.movies_staging")
+
+    with database.connection() as conn:
+        similarity_index.update_similarity_index(conn, movie_ids, previous_version)
+    return movie_ids
 
 
 def login_user(username):
-    cur.execute("UPDATE users "
-                "SET last_login = CURRENT_TIMESTAMP "
-                "WHERE username = ?",
-                (username,))
-    conn.commit()
+    with database.transaction() as conn:
+        cur = conn.cursor()
+        cur.execute("UPDATE users "
+                    "SET last_login = CURRENT_TIMESTAMP "
+                    "WHERE username = ?",
+                    (username,))
 
 
 def create_new_user(username):
-    cur.execute("INSERT INTO users(username) "
-                "VALUES(?)",
-                (username,))
-    conn.commit()
+    with database.transaction() as conn:
+        cur = conn.cursor()
+        cur.execute("INSERT INTO users(username) "
+                    "VALUES(?)",
+                    (username,))
 
 
 def delete_user(username):
-    cur.execute("DELETE FROM users "
-                "WHERE username = ? ",
-                (username,))
-    conn.commit()
+    with database.transaction() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT id FROM users WHERE username = ?", (username,))
+        user = cur.fetchone()
+        cur.execute("DELETE FROM users "
+                    "WHERE username = ? ",
+                    (username,))
+
+    if user is not None:
+        exclusion_cache.forget_user(user[0])
+        result_cache.forget_user(user[0])
 
 
 def get_users():
-    cur.execute("SELECT * FROM users")
-    return cur.fetchall()
+    with database.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT * FROM users")
+        return cur.fetchall()
 
 
 # This function selects movies whose titles are close enough to the searched term, excluding the user's ignored movies.
-def select_movie(movie_title, user_id):
+# Results come from five searches, each only run if the previous ones found fewer than 10 movies: titles starting with
+# the searched text, then the searched words, then the same words with the last one as a prefix, then titles
+# containing the searched text, and only if all of these found nothing, titles sharing the most three-letter sequences
+# with it, which tolerates typos. With all_fields, the word searches also look at the director, stars and overview,
+# ranked by bm25 with title matches ranked highest.
+def select_movie(movie_title, user_id, all_fields=False):
+    words = re.findall(r'\w+', movie_title.lower())
+    if not words:
+        return []
+
+    # Whole words are looked up first since they are much cheaper than prefixes longer than the prefix indexes. Only
+    # the last word, the one still being typed, is then searched as a prefix, unless it is a single character, which
+    # would match a large part of the vocabulary.
+    word_queries = [' '.join(fts_phrase(word) for word in words)]
+    if len(words[-1]) > 1:
+        word_queries.append(' '.join(fts_phrase(word) for word in words) + '*')
+    if not all_fields:
+        word_queries = ['title : (' + query + ')' for query in word_queries]
+    text = movie_title.strip().lower()
+
+    results = []
+    with database.connection() as conn:
+        cur = conn.cursor()
+
+        # Ignored movies are dropped using the user's cached exclusions. Each search fetches enough extra rows to
+        # still have 10 results when every ignored movie matches.
+        index = similarity_index.get_similarity_index(conn)
+        with instrumentation.span("search.exclusions"):
+            exclusions = exclusion_cache.get_user_exclusions(conn, user_id, index)
+            ignored = exclusions.ignored_mask()
+            limit = 10 + exclusions.ignored_count()
+
+        def add_results(rows):
+            found_ids = {row[0] for row in results}
+            results.extend(row for row in rows
+                           if row[0] not in found_ids and not (row[0] in index and ignored[index.position_of(row[0])]))
+
+        # The word searches only read their first matches, so a title made of a common word could be left out of them.
+        # Titles starting with the searched text are read in alphabetical order first, where the title matching it
+        # exactly always comes before the longer ones.
+        instrumentation.count("search.movies_title_lower")
+        cur.execute("SELECT id, title FROM movies "
+                    "WHERE lower(title) >= ? AND lower(title) < ? "
+                    "ORDER BY lower(title) LIMIT ?", (text, text + '\U0010ffff', SEARCH_CANDIDATES))
+        add_results(sorted(cur.fetchall(), key=lambda row: (len(row[1]), row[0]))[:limit])
+
+        for word_query in word_queries:
+            if len(results) >= 10:
+                break
+            instrumentation.count("search.movies_fts")
+            add_results(word_matches(cur, word_query, words, limit, all_fields))
+
+        if len(results) < 10 and len(text) >= 3:
+            instrumentation.count("search.movies_title_trigram")
+            cur.execute("SELECT m.id, m.title "
+                        "FROM (SELECT rowid FROM movies_title_trigram WHERE movies_title_trigram MATCH ? LIMIT ?) f "
+                        "INNER JOIN movies m ON m.id = f.rowid", (fts_phrase(text), limit))
+            add_results(cur.fetchall())
+
+        if not results and len(text) >= 3:
+            instrumentation.count("search.movies_title_trigram.typos")
+            add_results(typo_matches(cur, text)[:limit])
+
+    return results[:10]
+
+
+# Returns the movies matching an FTS5 query on movies_fts, best first. Matches are fetched with a plain LIMIT, so a
+# common word never has every match scored. Title searches are ranked by title length, which is mostly what bm25 would
+# tell their matches apart by since each contains every searched word, without bm25 first looking up how common each
+# word is in the whole catalog. Searches over every field use bm25 when few enough movies match, and otherwise rank
+# the matches with every searched word in the title first, then by title length.
+def word_matches(cur, word_query, words, limit, all_fields):
     cur.execute("SELECT m.id, m.title "
-                "FROM movies m "
-                "WHERE m.title LIKE ? AND "
-                "NOT EXISTS "
-                "(SELECT wh.movie_id "
-                "FROM watch_history wh "
-                "WHERE m.id = wh.movie_id AND ignored = 1 AND user_id = ?) "
-                "LIMIT 10", ('%' + movie_title + '%', user_id))
-    return cur.fetchall()
+                "FROM (SELECT rowid FROM movies_fts WHERE movies_fts MATCH ? LIMIT ?) f "
+                "INNER JOIN movies m ON m.id = f.rowid", (word_query, SEARCH_CANDIDATES + 1))
+    rows = cur.fetchall()
+    if not all_fields:
+        return sorted(rows[:SEARCH_CANDIDATES], key=lambda row: (len(row[1]), row[0]))[:limit]
+
+    if len(rows) <= SEARCH_CANDIDATES:
+        cur.execute("SELECT m.id, m.title "
+                    "FROM (SELECT rowid, bm25(movies_fts, " + SEARCH_WEIGHTS + ") AS score "
+                    "FROM movies_fts WHERE movies_fts MATCH ? ORDER BY score LIMIT ?) f "
+                    "INNER JOIN movies m ON m.id = f.rowid "
+                    "ORDER BY f.score", (word_query, limit))
+        return cur.fetchall()
+
+    def rank(row):
+        title_words = re.findall(r'\w+', row[1].lower())
+        in_title = all(any(title_word.startswith(word) for title_word in title_words) for word in words)
+        return not in_title, len(row[1]), row[0]
+    return sorted(rows[:SEARCH_CANDIDATES], key=rank)[:limit]
+
+
+# Returns the movies whose titles share at least TYPO_MIN_SHARED of the text's three-letter sequences, the titles
+# sharing the most first. Candidates are any SEARCH_CANDIDATES titles sharing one of them.
+def typo_matches(cur, text):
+    trigrams = {text[start:start + 3] for start in range(len(text) - 2)}
+    cur.execute("SELECT m.id, m.title "
+                "FROM (SELECT rowid FROM movies_title_trigram WHERE movies_title_trigram MATCH ? LIMIT ?) f "
+                "INNER JOIN movies m ON m.id = f.rowid",
+                (' OR '.join(fts_phrase(trigram) for trigram in sorted(trigrams)), SEARCH_CANDIDATES))
+
+    minimum = max(2, math.ceil(len(trigrams) * TYPO_MIN_SHARED))
+    scored = []
+    for movie_id, title in cur.fetchall():
+        lowered = title.lower()
+        shared = len(trigrams.intersection(lowered[start:start + 3] for start in range(len(lowered) - 2)))
+        if shared >= minimum:
+            scored.append((-shared, movie_id, title))
+    return [(movie_id, title) for _, movie_id, title in sorted(scored)]
+
+
+# Quotes text as an FTS5 string, so characters in a search term are never read as query syntax.
+def fts_phrase(text):
+    return '"' + text.replace('"', '""') + '"'
 
 
 def insert_or_update_watch_history(user_data):
-    cur.execute("INSERT INTO watch_history(user_id, movie_id, watched, liked, ignored, last_edited) "
-                "VALUES(?, ?, ?, ?, ?, CURRENT_TIMESTAMP) "
-                "ON CONFLICT (user_id, movie_id) DO UPDATE "
-                "SET watched = ?, liked = ?, ignored = ?, last_edited = CURRENT_TIMESTAMP",
-                (user_data[0], user_data[1], user_data[2], user_data[3], user_data[4],
-                 user_data[2], user_data[3], user_data[4],))
-    conn.commit()
+    with database.transaction() as conn:
+        cur = conn.cursor()
+        cur.execute("INSERT INTO watch_history(user_id, movie_id, watched, liked, ignored, last_edited) "
+                    "VALUES(?, ?, ?, ?, ?, CURRENT_TIMESTAMP) "
+                    "ON CONFLICT (user_id, movie_id) DO UPDATE "
+                    "SET watched = ?, liked = ?, ignored = ?, last_edited = CURRENT_TIMESTAMP",
+                    (user_data[0], user_data[1], user_data[2], user_data[3], user_data[4],
+                     user_data[2], user_data[3], user_data[4],))
+
+    # The cached exclusions of the user are updated in place once the change is committed, and their cached results
+    # are dropped.
+    exclusion_cache.record_watch_history(user_data[0], user_data[1], user_data[2], user_data[4])
+    result_cache.forget_user(user_data[0])
+
+
+# Returns the recommendations last precomputed for a user as (movie ID, title, score, reason movie ID, created at)
+# rows, best first.
+def get_user_recommendations(user_id):
+    with database.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT m.id, m.title, ur.score, ur.reason_movie_id, ur.created_at "
+                    "FROM user_recommendations ur "
+                    "INNER JOIN movies m ON m.id = ur.movie_id "
+                    "WHERE ur.user_id = ? "
+                    "ORDER BY ur.rank", (user_id,))
+        return cur.fetchall()
 
 
 def get_watch_history(user_id):
-    cur.execute("SELECT m.id, m.title, wh.watched, wh.liked, wh.ignored "
-                "FROM movies m "
-                "INNER JOIN watch_history wh ON wh.movie_id = m.id "
-                "WHERE wh.user_id = ? "
-                "ORDER BY wh.last_edited DESC", (user_id,))
-    return cur.fetchall()
+    with database.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT m.id, m.title, wh.watched, wh.liked, wh.ignored "
+                    "FROM movies m "
+                    "INNER JOIN watch_history wh ON wh.movie_id = m.id "
+                    "WHERE wh.user_id = ? "
+                    "ORDER BY wh.last_edited DESC", (user_id,))
+        return cur.fetchall()
@@ -0,0 +1,91 @@
+import csv
+import random
+
+GENRES = ['Action', 'Adventure', 'Animation', 'Biography', 'Comedy', 'Crime', 'Drama', 'Family', 'Fantasy',
+          'Film-Noir', 'History', 'Horror', 'Music', 'Musical', 'Mystery', 'Romance', 'Sci-Fi', 'Sport',
+          'Thriller', 'War', 'Western']
+
+WORDS = ['young', 'man', 'woman', 'family', 'war', 'love', 'life', 'friend', 'world', 'story', 'city', 'team',
+         'detective', 'murder', 'journey', 'secret', 'father', 'mother', 'son', 'daughter', 'king', 'soldier',
+         'police', 'prison', 'escape', 'school', 'town', 'small', 'group', 'find', 'must', 'help', 'return',
+         'home', 'past', 'future', 'power', 'boy', 'girl', 'crime', 'gang', 'money', 'plan', 'dream', 'island',
+         'ship', 'space', 'planet', 'robot', 'alien', 'ghost', 'house', 'night', 'truth', 'revenge', 'brother',
+         'sister', 'wife', 'husband', 'village', 'hero', 'battle', 'empire', 'rebel', 'doctor', 'lawyer',
+         'journalist', 'artist', 'musician', 'band', 'race', 'boxer', 'game', 'coach', 'student', 'teacher']
+
+FIRST_NAMES = ['James', 'Mary', 'John', 'Patricia', 'Robert', 'Jennifer', 'Michael', 'Linda', 'David', 'Akira',
+               'Ingrid', 'Satyajit', 'Agnes', 'Pedro', 'Wong', 'Federico', 'Sofia', 'Hayao', 'Bong', 'Lena']
+
+LAST_NAMES = ['Smith', 'Johnson', 'Kurosawa', 'Bergman', 'Ray', 'Varda', 'Almodovar', 'Kar-wai', 'Fellini',
+              'Coppola', 'Miyazaki', 'Joon-ho', 'Garcia', 'Martin', 'Lee', 'Brown', 'Wilson', 'Moore', 'Taylor']
+
+MOVIES_COLUMNS = ['poster_link', 'title', 'year', 'certificate', 'runtime', 'genre', 'imdb_rating', 'overview',
+                  'meta_score', 'director', 'star1', 'star2', 'star3', 'star4', 'similarity_tags']
+
+
+def random_person(rng):
+    return rng.choice(FIRST_NAMES) + ' ' + rng.choice(LAST_NAMES)
+
+
+# Returns one synthetic movie as a dictionary with every column of the movies table. The tags are built directly from
+# the genre and overview words, so no NLTK corpora are needed to generate them.
+def synthetic_movie(rng, number):
+    genres = rng.sample(GENRES, rng.randint(1, 3))
+    overview_words = [rng.choice(WORDS) for _ in range(rng.randint(12, 30))]
+    return {
+        'poster_link': None,
+        'title': ' '.join(rng.choice(WORDS).capitalize() for _ in range(rng.randint(1, 4))) + ' ' + str(number),
+        'year': rng.randint(1920, 2024),
+        'certificate': rng.choice(['U', 'UA', 'A', 'PG-13', 'R']),
+        'runtime': str(rng.randint(70, 200)) + ' min',
+        'genre': ', '.join(genres),
+        'imdb_rating': round(rng.uniform(5.0, 9.5), 1),
+        'overview': ' '.join(overview_words).capitalize() + '.',
+        'meta_score': rng.randint(30, 100),
+        'director': random_person(rng),
+        'star1': random_person(rng),
+        'star2': random_person(rng),
+        'star3': random_person(rng),
+        'star4': random_person(rng),
+        'similarity_tags': ' '.join(genre.lower() for genre in genres) + ' ' + ' '.join(overview_words),
+    }
+
+
+# Fills an empty database created by generate_tables with synthetic movies, users and watch history.
+# Every user gets history_size watch history rows, with a mix of watched, liked and ignored movies.
+def populate_database(conn, movie_count, user_count, history_size, seed=0):
+    rng = random.Random(seed)
+    placeholders = ', '.join('?' * len(MOVIES_COLUMNS))
+
+    conn.executemany("INSERT INTO movies(" + ', '.join(MOVIES_COLUMNS) + ") VALUES(" + placeholders + ")",
+                     ([movie[column] for column in MOVIES_COLUMNS]
+                      for movie in (synthetic_movie(rng, number) for number in range(movie_count))))
+    conn.executemany("INSERT INTO users(username) VALUES(?)",
+                     (("user" + str(number),) for number in range(user_count)))
+
+    movie_ids = [row[0] for row in conn.execute("SELECT id FROM movies")]
+    user_ids = [row[0] for row in conn.execute("SELECT id FROM users")]
+    history = []
+    for user_id in user_ids:
+        for movie_id in rng.sample(movie_ids, min(history_size, len(movie_ids))):
+            watched = int(rng.random() < 0.7)
+            liked = int(watched and rng.random() < 0.5)
+            ignored = int(not watched and rng.random() < 0.3)
+            history.append((user_id, movie_id, watched, liked, ignored, rng.randint(0, 365)))
+
+    conn.executemany("INSERT INTO watch_history(user_id, movie_id, watched, liked, ignored, last_edited) "
+                     "VALUES(?, ?, ?, ?, ?, datetime('now', '-' || ? || ' days'))", history)
+    conn.commit()
+    return user_ids
+
+
+# Writes synthetic movies to a CSV laid out like imdb_top_1000.csv, with a header row and no tags, for loading tests.
+def write_movies_csv(path, movie_count, seed=0):
+    rng = random.Random(seed)
+    columns = MOVIES_COLUMNS[:-1]
+    with open(path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(columns)
+        for number in range(movie_count):
+            movie = synthetic_movie(rng, number)
+            writer.writerow(['' if movie[column] is None else movie[column] for column in columns])
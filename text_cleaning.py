@@ -0,0 +1,104 @@
+import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+# Maximum number of distinct words whose lemma is remembered by a cleaner.
+LEMMA_CACHE_SIZE = 100000
+
+# Number of texts sent to a worker process at a time when cleaning in parallel.
+BATCH_SIZE = 2000
+
+PUNCTUATION = re.compile(r'[^\w\s\d]')
+
+# The NLTK corpora needed for cleaning, which have to be installed locally beforehand.
+REQUIRED_CORPORA = ['stopwords', 'wordnet']
+
+# The cleaner shared by everything in this process, created on first use.
+_tag_cleaner = None
+
+
+# Turns movie descriptions into similarity tags. The stopwords and the lemmatizer are loaded once per cleaner, and
+# lemmas are memoized since the same words come up in most descriptions.
+class TagCleaner:
+    def __init__(self, lemma_cache_size=LEMMA_CACHE_SIZE):
+        check_corpora()
+        from nltk import WordNetLemmatizer
+        from nltk.corpus import stopwords
+
+        self.stopwords = frozenset(stopwords.words('english'))
+        self.lemmatize = lru_cache(maxsize=lemma_cache_size)(WordNetLemmatizer().lemmatize)
+
+    # This converts text to lowercase, removes punctuation and stopwords, and then lemmatizes everything else.
+    def clean(self, text):
+        # Once punctuation is removed, tokenizing the text comes down to splitting it on whitespace.
+        words = PUNCTUATION.sub('', text.lower()).split()
+        return ' '.join(self.lemmatize(word) for word in words if word not in self.stopwords)
+
+    # Cleans a list of texts, returning the tags in the same order.
+    # With more than one process, the texts are split into batches which are cleaned by a pool of worker processes.
+    def clean_many(self, texts, processes=None):
+        texts = list(texts)
+        if processes is None or processes <= 1 or len(texts) <= BATCH_SIZE:
+            return [self.clean(text) for text in texts]
+
+        batches = [texts[start:start + BATCH_SIZE] for start in range(0, len(texts), BATCH_SIZE)]
+        with ProcessPoolExecutor(processes) as pool:
+            return [tags for batch in pool.map(_clean_batch, batches) for tags in batch]
+
+    # Cleans a stream of chunks, yielding every chunk with the tags of its items in order, where text_of gives the text
+    # of an item. With more than one process, one pool of worker processes cleans up to that many chunks ahead of the
+    # one being yielded, so cleaning goes on while the caller stores the previous tags.
+    def clean_chunks(self, chunks, text_of, processes=None):
+        if processes is None or processes <= 1:
+            for chunk in chunks:
+                yield chunk, [self.clean(text_of(item)) for item in chunk]
+            return
+
+        with ProcessPoolExecutor(processes) as pool:
+            pending = deque()
+            for chunk in chunks:
+                texts = [text_of(item) for item in chunk]
+                pending.append((chunk, [pool.submit(_clean_batch, texts[start:start + BATCH_SIZE])
+                                        for start in range(0, len(texts), BATCH_SIZE)]))
+                if len(pending) > processes:
+                    yield _cleaned(*pending.popleft())
+            while pending:
+                yield _cleaned(*pending.popleft())
+
+
+# Makes sure the NLTK corpora are installed, without ever trying to download them. NLTK is only imported here, the
+# first time tags are actually cleaned, so starting the program does not pay for it.
+def check_corpora():
+    import nltk
+
+    missing = []
+    for corpus in REQUIRED_CORPORA:
+        try:
+            nltk.data.find('corpora/' + corpus)
+        except LookupError:
+            try:
+                nltk.data.find('corpora/' + corpus + '.zip')
+            except LookupError:
+                missing.append(corpus)
+
+    if missing:
+        raise LookupError("The NLTK corpora " + ', '.join(missing) + " are not installed, so tags cannot be cleaned. "
+                          "Install them with: python -m nltk.downloader " + ' '.join(missing))
+
+
+# Returns the cleaner shared by everything in this process.
+def get_tag_cleaner():
+    global _tag_cleaner
+    if _tag_cleaner is None:
+        _tag_cleaner = TagCleaner()
+    return _tag_cleaner
+
+
+# Runs in the worker processes of TagCleaner.clean_many, each of which builds its own shared cleaner once.
+def _clean_batch(texts):
+    return get_tag_cleaner().clean_many(texts)
+
+
+def _cleaned(chunk, futures):
+    return chunk, [tags for future in futures for tags in future.result()]